@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of mergedicts(), the merge behind expected_partial and
+# expected_absent, on pillars holding long lists of dicts.
+#
+#   ./benchmarks/bench_mergedicts.py [--sizes 1000 5000 20000] [--repeat 5]
+
+import os
+import sys
+import timeit
+import argparse
+import importlib.util
+
+def load_template_tester():
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "template-tester.py")
+    spec = importlib.util.spec_from_file_location("template_tester", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def generate_pillar(size):
+    return {
+        'firewall': {
+            'rules': [
+                {
+                    'name': "rule{}".format(i),
+                    'port': 1024 + i,
+                    'proto': "tcp" if i % 2 else "udp",
+                    'sources': ["10.{}.{}.0/24".format(i % 256, (i // 256) % 256)],
+                }
+                for i in range(size)
+            ],
+        },
+        'users': dict(
+            ("user{}".format(i), {'uid': 1000 + i, 'shell': "/bin/bash", 'groups': ["users"]})
+            for i in range(size)
+        ),
+    }
+
+def generate_expected(pillar):
+    return {
+        'firewall': {'rules': pillar['firewall']['rules'][::10]},
+        'users': {'__*': {'shell': "/bin/bash"}},
+    }
+
+def generate_deep(depth):
+    pillar = {}
+    node = pillar
+    for i in range(depth):
+        node['level'] = {'value': i}
+        node = node['level']
+    return pillar
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+      '--sizes',
+      help="Number of list items and dict keys of the generated pillars",
+      default=[1000, 5000, 20000],
+      nargs="+",
+      type=int
+    )
+    parser.add_argument(
+      '--repeat',
+      help="Number of runs per size, the best one is reported",
+      default=5,
+      type=int
+    )
+    args = parser.parse_args()
+
+    template_tester = load_template_tester()
+
+    print("{:>8} {:>12} {:>12}".format("size", "best (ms)", "us/item"))
+    for size in args.sizes:
+        pillar = generate_pillar(size)
+        expected = generate_expected(pillar)
+        best = min(timeit.repeat(
+            lambda: dict(template_tester.mergedicts(pillar, expected)),
+            number=1,
+            repeat=args.repeat
+        ))
+        print("{:>8} {:>12.2f} {:>12.2f}".format(size, best * 1000, best * 1000000 / size))
+
+    depth = 10 * sys.getrecursionlimit()
+    deep = generate_deep(depth)
+    best = min(timeit.repeat(
+        lambda: dict(template_tester.mergedicts(deep, deep)),
+        number=1,
+        repeat=args.repeat
+    ))
+    print("nesting depth {}: {:.2f} ms".format(depth, best * 1000))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Benchmark suite of the tester: end-to-end throughput on a synthetic
+# pillarstack tree (see generate_tree.py), and micro-benchmarks of the merge,
+# the partial and absence matchers, the JSONPath lookups and the diff of the
+# failed tests.
+#
+#   ./benchmarks/bench_suite.py [--templates 200] [--jobs 1 4] [--save] [--compare REV]
+#
+# --save appends the results to benchmarks/results.jsonl with the current git
+# commit, --compare prints the ratios against the last results saved for REV.
+
+import os
+import sys
+import json
+import time
+import timeit
+import difflib
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+
+import generate_tree
+import bench_mergedicts
+
+benchmarks_dir = os.path.dirname(os.path.realpath(__file__))
+template_tester_path = os.path.join(benchmarks_dir, "..", "template-tester.py")
+results_path = os.path.join(benchmarks_dir, "results.jsonl")
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=benchmarks_dir, universal_newlines=True
+        ).strip()
+        status = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=benchmarks_dir, universal_newlines=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    if status.strip():
+        revision += "-dirty"
+    return revision
+
+def best_of(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def bench_end_to_end(args, results):
+    with tempfile.TemporaryDirectory() as directory:
+        count = generate_tree.generate_tree(directory, args.templates, args.items, args.depth)
+        for jobs in args.jobs:
+            command = [
+                sys.executable, template_tester_path, "-n", "--cache-dir", "", "--jobs", str(jobs), "tests/bench"
+            ]
+            durations = []
+            for i in range(args.repeat):
+                started = time.perf_counter()
+                process = subprocess.run(command, cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                durations.append(time.perf_counter() - started)
+                if process.returncode != 0:
+                    sys.stdout.write(process.stdout.decode("utf-8", "replace"))
+                    print("Error: the generated tests failed")
+                    sys.exit(1)
+            best = min(durations)
+            results["end_to_end_jobs{}".format(jobs)] = best
+            print("end to end, {} test files, {} jobs: {:.2f} s, {:.1f} tests/s".format(
+                count, jobs, best, count / best
+            ))
+
+def bench_micro(args, results, template_tester):
+    pillar = bench_mergedicts.generate_pillar(args.size)
+    expected = bench_mergedicts.generate_expected(pillar)
+    absent = {'firewall': {'missing': None}}
+    changed = bench_mergedicts.generate_pillar(args.size)
+    changed['firewall']['rules'][args.size // 2]['port'] = 0
+
+    def diff():
+        return list(difflib.unified_diff(
+            template_tester.yaml_dump(pillar).splitlines(keepends=True),
+            template_tester.yaml_dump(changed).splitlines(keepends=True),
+            fromfile="expected",
+            tofile="generated",
+        ))
+
+    micro_benchmarks = [
+        ("mergedicts", lambda: dict(template_tester.mergedicts(pillar, expected))),
+        ("match_partial", lambda: template_tester.match_partial(expected, pillar)),
+        ("match_absent", lambda: template_tester.match_absent(absent, pillar)),
+        ("get_item_from_pattern", lambda: template_tester.get_item_from_pattern("firewall.rules.[*].port", pillar)),
+        ("diff", diff),
+    ]
+    for name, function in micro_benchmarks:
+        best = best_of(function, args.repeat)
+        results[name] = best
+        print("{}, size {}: {:.3f} ms".format(name, args.size, best * 1000))
+
+def load_saved_results(revision):
+    saved = None
+    if os.path.exists(results_path):
+        with open(results_path, encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['commit'].startswith(revision):
+                    saved = entry
+    return saved
+
+def print_comparison(entry, saved):
+    print("{:<24} {:>12} {:>12} {:>8}".format("benchmark", saved['commit'], entry['commit'], "ratio"))
+    for name, duration in entry['results'].items():
+        if name not in saved['results']:
+            continue
+        print("{:<24} {:>11.4f}s {:>11.4f}s {:>7.2f}x".format(
+            name, saved['results'][name], duration, saved['results'][name] / duration
+        ))
+    if saved['params'] != entry['params']:
+        print("Warning: the results were measured with other parameters: {}".format(saved['params']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+      '--templates',
+      help="Number of generated templates for the end to end benchmark, each one is tested by 8 test files",
+      default=200,
+      type=int
+    )
+    parser.add_argument(
+      '--items',
+      help="Number of users and groups generated by each template",
+      default=50,
+      type=int
+    )
+    parser.add_argument(
+      '--depth',
+      help="Nesting depth of the deep dict of each template",
+      default=8,
+      type=int
+    )
+    parser.add_argument(
+      '--jobs',
+      help="Numbers of jobs of the end to end runs",
+      default=[1],
+      nargs="+",
+      type=int
+    )
+    parser.add_argument(
+      '--size',
+      help="Number of list items and dict keys of the micro-benchmark pillars",
+      default=5000,
+      type=int
+    )
+    parser.add_argument(
+      '--repeat',
+      help="Number of runs per benchmark, the best one is reported",
+      default=3,
+      type=int
+    )
+    parser.add_argument(
+      '--skip-end-to-end',
+      help="Only run the micro-benchmarks",
+      default=False,
+      action="store_true"
+    )
+    parser.add_argument(
+      '--save',
+      help="Append the results to benchmarks/results.jsonl",
+      default=False,
+      action="store_true"
+    )
+    parser.add_argument(
+      '--compare',
+      help="Compare the results with the last ones saved for this git revision",
+      default=None,
+      type=str
+    )
+    args = parser.parse_args()
+
+    template_tester = bench_mergedicts.load_template_tester()
+
+    results = {}
+    if not args.skip_end_to_end:
+        bench_end_to_end(args, results)
+    bench_micro(args, results, template_tester)
+
+    entry = {
+        'commit': git_revision(),
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'params': {
+            'templates': args.templates,
+            'items': args.items,
+            'depth': args.depth,
+            'size': args.size,
+        },
+        'results': results,
+    }
+
+    if args.compare:
+        saved = load_saved_results(args.compare)
+        if saved is None:
+            print("Error: no saved results for {}".format(args.compare))
+        else:
+            print_comparison(entry, saved)
+
+    if args.save:
+        with open(results_path, 'a', encoding="utf-8") as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+        print("Results saved in {} for {}".format(results_path, entry['commit']))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Generator of a synthetic pillarstack tree: templates with long lists of
+# dicts, deeply nested dicts and loops/conditions, and passing test files using
+# every assertion kind.
+#
+#   ./benchmarks/generate_tree.py DIRECTORY [--templates 1000] [--items 50] [--depth 8]
+#
+# The tests are run from DIRECTORY with:
+#
+#   cd DIRECTORY && template-tester.py tests/bench
+
+import os
+import argparse
+
+import yaml
+
+macros_template = """{% macro shell(n) %}{{ '/bin/bash' if n is even else '/bin/zsh' }}{% endmacro %}
+{% macro enabled(os) %}{{ 'true' if os == 'Debian' else 'false' }}{% endmacro %}
+"""
+
+pillar_template = """{{% import "bench/macros.jinja" as m %}}
+node{index}:
+  os: {{{{ __grains__.os }}}}
+  enabled: {{{{ m.enabled(__grains__.os) }}}}
+  users:
+{{% for n in range(pillar.users) %}}
+    - name: user{{{{ n }}}}
+      uid: {{{{ 1000 + n }}}}
+      shell: {{{{ m.shell(n) }}}}
+{{% if n % 10 == 0 %}}
+      admin: true
+{{% endif %}}
+{{% endfor %}}
+  groups:
+{{% for n in range(pillar.users) %}}
+    group{{{{ n }}}}:
+      gid: {{{{ 2000 + n }}}}
+      members: [user{{{{ n }}}}]
+{{% endfor %}}
+{deep}
+"""
+
+def deep_template(depth):
+    lines = ["  deep:"]
+    for level in range(depth):
+        lines.append("{}level{}:".format("  " * (level + 2), level))
+        lines.append("{}name: level{}".format("  " * (level + 3), level))
+    lines.append("{}value: {{{{ pillar.seed }}}}".format("  " * (depth + 2)))
+    return "\n".join(lines)
+
+def deep_data(depth, seed):
+    data = {'value': seed}
+    for level in reversed(range(depth)):
+        data['name'] = "level{}".format(level)
+        data = {"level{}".format(level): data}
+    return data
+
+def rendered_data(index, items, depth):
+    users = []
+    for n in range(items):
+        user = {'name': "user{}".format(n), 'uid': 1000 + n, 'shell': "/bin/bash" if n % 2 == 0 else "/bin/zsh"}
+        if n % 10 == 0:
+            user['admin'] = True
+        users.append(user)
+    return {
+        'node{}'.format(index): {
+            'os': "Debian",
+            'enabled': True,
+            'users': users,
+            'groups': dict(
+                ("group{}".format(n), {'gid': 2000 + n, 'members': ["user{}".format(n)]})
+                for n in range(items)
+            ),
+            'deep': deep_data(depth, index),
+        }
+    }
+
+def test_files(index, items, depth):
+    node = 'node{}'.format(index)
+    data = rendered_data(index, items, depth)
+    return {
+        'expected': {'expected': data},
+        'expected_partial': {'expected_partial': {node: {
+            'users': data[node]['users'][::10],
+            'groups': {'group0': {'gid': 2000}},
+        }}},
+        'expected_absent': {'expected_absent': {node: {'missing': None}}},
+        'content_partial': {'content_partial': "- name: user{}\n".format(items - 1)},
+        'check_list': {'check_list': {"{}.users".format(node): {'morethan': items - 1}}},
+        'check_string': {'check_string': {"{}.users.[*].shell".format(node): {'contains': "/bin/"}}},
+        'check_int': {'check_int': {"{}.groups.*.gid".format(node): {'greaterthan': 1999}}},
+        'check_bool': {'check_bool': {"{}.enabled".format(node): {'is': True}}},
+    }
+
+def generate_tree(directory, templates, items, depth):
+    pillar_dir = os.path.join(directory, "pillars", "bench")
+    test_dir = os.path.join(directory, "tests", "bench")
+    os.makedirs(pillar_dir, exist_ok=True)
+    os.makedirs(test_dir, exist_ok=True)
+    with open(os.path.join(pillar_dir, "macros.jinja"), 'w', encoding="utf-8") as f:
+        f.write(macros_template)
+
+    count = 0
+    for index in range(templates):
+        template_name = "pillars/bench/t{:05d}.yml".format(index)
+        with open(os.path.join(directory, template_name), 'w', encoding="utf-8") as f:
+            f.write(pillar_template.format(index=index, deep=deep_template(depth)))
+        for kind, assertion in test_files(index, items, depth).items():
+            test = {
+                'file': template_name,
+                'variables': {
+                    'pillar': {'users': items, 'seed': index},
+                    '__grains__': {'os': "Debian"},
+                },
+            }
+            test.update(assertion)
+            with open(os.path.join(test_dir, "t{:05d}_{}.yml".format(index, kind)), 'w', encoding="utf-8") as f:
+                yaml.safe_dump(test, f, default_flow_style=False)
+            count += 1
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+      'directory',
+      help="Directory receiving the pillars/ and tests/ trees"
+    )
+    parser.add_argument(
+      '--templates',
+      help="Number of generated templates, each one is tested by 8 test files",
+      default=1000,
+      type=int
+    )
+    parser.add_argument(
+      '--items',
+      help="Number of users and groups generated by each template",
+      default=50,
+      type=int
+    )
+    parser.add_argument(
+      '--depth',
+      help="Nesting depth of the deep dict of each template",
+      default=8,
+      type=int
+    )
+    args = parser.parse_args()
+
+    count = generate_tree(args.directory, args.templates, args.items, args.depth)
+    print("{} templates and {} test files written in {}".format(args.templates, count, args.directory))
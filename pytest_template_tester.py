@@ -0,0 +1,84 @@
+# pytest plugin collecting the test files of template-tester, one test item per
+# target template, so the pillar tests run with pytest-xdist, --lf and the
+# pytest reports:
+#
+#   PYTHONPATH=/path/to/template-tester pytest -p pytest_template_tester tests/
+
+import os
+
+import pytest
+
+import template_tester
+
+tester_config_key = pytest.StashKey()
+
+def pytest_addoption(parser):
+    group = parser.getgroup("template-tester")
+    group.addoption(
+      '--template-tester-cache-dir',
+      help="Directory of the persistent caches of template-tester, empty to disable them",
+      default=None
+    )
+    group.addoption(
+      '--template-tester-diff',
+      help="Diff of the failed tests, like the --diff option of template-tester",
+      default="auto",
+      choices=["auto", "text", "tree"]
+    )
+
+def pytest_configure(config):
+    config.stash[tester_config_key] = template_tester.configure(
+        cache_dir=config.getoption('template_tester_cache_dir'),
+        diff=config.getoption('template_tester_diff'),
+        verbose_output=config.getoption('verbose') > 1,
+    )
+
+def pytest_collect_file(file_path, parent):
+    if file_path.suffix != ".yml":
+        return None
+    testfile = os.path.relpath(str(file_path))
+    test_dir = os.path.normpath(template_tester.configured_test_dir(parent.config.stash[tester_config_key]))
+    if not testfile.startswith(test_dir + os.sep) or testfile == "tests/template-tester.yml":
+        return None
+    return TemplateTestFile.from_parent(parent, path=file_path)
+
+class TemplateTestFailure(Exception):
+    def __init__(self, records, output):
+        super().__init__()
+        self.records = records
+        self.output = output
+
+class TemplateTestFile(pytest.File):
+    def collect(self):
+        testfile = os.path.relpath(str(self.path))
+        targets = template_tester.test_file_targets(testfile)
+        if not targets:
+            yield TemplateTestItem.from_parent(self, name=os.path.basename(testfile), testfile=testfile, targets=None)
+        for target in targets:
+            yield TemplateTestItem.from_parent(self, name=target, testfile=testfile, targets=[target])
+
+class TemplateTestItem(pytest.Item):
+    def __init__(self, *, testfile, targets, **kwargs):
+        super().__init__(**kwargs)
+        self.testfile = testfile
+        self.targets = targets
+
+    def runtest(self):
+        records, output = template_tester.run_test(self.config.stash[tester_config_key], self.testfile, self.targets)
+        for record in records:
+            self.user_properties.append((record['target'] or record['test'], record['status']))
+        failed_records = [record for record in records if record['status'] != "passed"]
+        if failed_records or not records:
+            raise TemplateTestFailure(failed_records, output)
+
+    def repr_failure(self, excinfo):
+        if isinstance(excinfo.value, TemplateTestFailure):
+            reasons = [
+                "{}: {}".format(record['target'] or record['test'], record['reason'])
+                for record in excinfo.value.records
+            ]
+            return "\n".join(reasons + [excinfo.value.output.rstrip()])
+        return super().repr_failure(excinfo)
+
+    def reportinfo(self):
+        return self.path, None, "{}::{}".format(self.testfile, self.name)
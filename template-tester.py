@@ -1,522 +1,2814 @@
 #!/usr/bin/env python3
 
+import io
 import os
+import re
+import ast
 import sys
-import copy
+import html
 import glob
-import yaml
-import jinja2
+import json
+import time
+import copy
+import pickle
+import fnmatch
+import itertools
+import pstats
+import cProfile
+import queue
+import socket
 import difflib
-import colorama
+import hashlib
+import collections
 import datetime
 import argparse
+import subprocess
+import threading
 import importlib
-import jsonpath_rw
+import traceback
+import contextlib
+import tracemalloc
 import configparser
+import multiprocessing
+import multiprocessing.connection
+
+default_socket_path = ".template-tester.sock"
+
+def run_client(argv):
+    # Thin client of the "server" subcommand. It only needs the standard
+    # library, so it starts without importing salt.
+    parser = argparse.ArgumentParser(
+      prog="template-tester.py client",
+      description="Run the tests through a template-tester server, the other options are the ones of template-tester.py"
+    )
+    parser.add_argument(
+      '--socket',
+      help="Unix socket of the server",
+      default=default_socket_path,
+      type=str
+    )
+    args, test_args = parser.parse_known_args(argv)
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(args.socket)
+    except OSError as e:
+        print("Error: unable to connect to the server on {}: {}".format(args.socket, e))
+        return(1)
+    request = {'cwd': os.getcwd(), 'argv': test_args}
+    connection.sendall((json.dumps(request) + "\n").encode("utf-8"))
+    connection.shutdown(socket.SHUT_WR)
+
+    return_value = 1
+    for line in connection.makefile('r', encoding="utf-8"):
+        message = json.loads(line)
+        if 'stdout' in message:
+            sys.stdout.write(message['stdout'])
+        elif 'stderr' in message:
+            sys.stderr.write(message['stderr'])
+        elif 'exit' in message:
+            return_value = message['exit']
+    connection.close()
+    return(return_value)
+
+if __name__ == "__main__" and sys.argv[1:2] == ["client"]:
+    sys.exit(run_client(sys.argv[2:]))
+
+import yaml
+import jinja2
+import colorama
+import jsonpath_rw
+import jinja2.sandbox
+import jinja2.bccache
+import jinja2.compiler
+import salt.utils.data
+import salt.pillar.stack
 import salt.utils.templates
+import salt.utils.jinja
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 no_color = False
 verbose = False
+diff_mode = "auto"
 __opts__ = {}
 
-def mergedicts(dict1, dict2_):
-  dict2 = dict2_.copy()
-  d2ks = dict2.copy().keys()
-  for d2k in d2ks:
-    if d2k == "__*":
-      for kk in dict1.keys():
-        dict2[kk] = dict2["__*"]
-        dict2[kk].update(dict1[kk])
-  if "__*" in dict2:
-    dict2.pop("__*")
-
-  for k in set(dict1.keys()).union(dict2.keys()):
-    if k in dict1 and k in dict2:
-      if isinstance(dict1[k], dict) and isinstance(dict2[k], dict):
-        yield (k, dict(mergedicts(dict1[k], dict2[k])))
-      elif isinstance(dict1[k], list) and isinstance(dict2[k], list):
-        try:
-          dict1[k].sort()
-          dict2[k].sort()
-        except:
-          pass
-        try:
-          yield (k, sorted(list(set(dict1[k] + dict2[k]))))
-        except Exception as e:
-          try:
-            res = dict1[k] + [i for i in dict2[k] if i not in dict1[k]]
+# libyaml based loader and dumpers when available, they give the same results
+yaml_safe_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+yaml_safe_dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+yaml_dumper = getattr(yaml, "CDumper", yaml.Dumper)
+yaml_cache = {}
+yaml_cache_dir = None
+
+def yaml_load(data):
+    return yaml.load(data, Loader=yaml_safe_loader)
+
+def yaml_dump(data):
+    if not isinstance(data, (dict, list)):
+        # libyaml does not end a document holding a single scalar with "..."
+        return yaml.dump(data, Dumper=yaml.SafeDumper)
+    return yaml.dump(data, Dumper=yaml_safe_dumper)
+
+def load_yaml_cached(data):
+    # Parsed documents are cached by content, in memory and in the cache
+    # directory. They are stored pickled, so every caller gets its own copy.
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    key = hashlib.sha256(
+        "{}\0{}\0".format(yaml.__version__, yaml_safe_loader.__name__).encode("utf-8") + data
+    ).hexdigest()
+    if key not in yaml_cache:
+        cache_path = None
+        if yaml_cache_dir:
+            cache_path = os.path.join(yaml_cache_dir, key + ".pickle")
             try:
-              res = sorted(res)
-            except:
-              pass
-            yield (k, res)
-          except Exception as ee:
-            raise ee
+                yaml_cache[key] = open(cache_path, 'rb').read()
+            except OSError:
+                pass
+        if key not in yaml_cache:
+            yaml_cache[key] = pickle.dumps(yaml_load(data))
+            if cache_path:
+                f = open(cache_path + ".tmp{}".format(os.getpid()), 'wb')
+                f.write(yaml_cache[key])
+                f.close()
+                os.replace(cache_path + ".tmp{}".format(os.getpid()), cache_path)
+    return pickle.loads(yaml_cache[key])
+
+def canonical_key(value):
+  # Hashable key of a value, equal for values which compare equal. Built
+  # without recursion, so deeply nested values do not hit the recursion limit.
+  results = []
+  stack = [(value, None)]
+  while stack:
+    node, children = stack.pop()
+    if isinstance(node, (dict, list)):
+      if children is None:
+        values = list(node.values()) if isinstance(node, dict) else node
+        stack.append((node, len(values)))
+        stack.extend((child, None) for child in reversed(values))
+        continue
+      items = results[len(results) - children:]
+      del results[len(results) - children:]
+      if isinstance(node, dict):
+        results.append(("__dict__", frozenset(zip(node.keys(), items))))
       else:
-        # If one of the values is not a dict, you can't continue merging it.
-        # Value from second dict overrides one in first and we move on.
-        yield (k, dict2[k])
-        # Alternatively, replace this with exception raiser to alert you of value conflicts
-    elif k in dict1:
-      yield (k, dict1[k])
+        results.append(("__list__", tuple(items)))
+    elif isinstance(node, (set, frozenset)):
+      results.append(("__set__", frozenset(node)))
     else:
-      yield (k, dict2[k])
-
-def check_dict_not_in_dict(needle, haystack):
-  for key, value in needle.items():
-    if value is None:
-      r = key not in haystack
-      if not r:
-        del(haystack[key])
-      return r
-    if key not in haystack:
-      return True
-    return check_dict_not_in_dict(needle[key], haystack[key])
-  return False
-
-def write_output(dirname, filename, content):
-    output_dir = os.path.join(dirname, os.path.dirname(filename))
-    basename = os.path.basename(filename)
-    os.makedirs(output_dir, exist_ok=True)
-    f = open(os.path.join(output_dir, basename), 'w', encoding="utf-8")
-    f.write(content)
+      # Raises TypeError for unhashable values
+      hash(node)
+      results.append(node)
+  return results[0]
+
+def merge_lists(list1, list2):
+  try:
+    list1 = sorted(list1)
+    list2 = sorted(list2)
+  except Exception:
+    pass
+  try:
+    return sorted(set(list1 + list2)), list1
+  except Exception:
+    pass
+  try:
+    keys = set(canonical_key(item) for item in list1)
+    merged = list1 + [item for item in list2 if canonical_key(item) not in keys]
+  except TypeError:
+    merged = list1 + [item for item in list2 if item not in list1]
+  try:
+    merged = sorted(merged)
+  except Exception:
+    pass
+  return merged, list1
+
+def expand_wildcard(dict1, dict2):
+  # "__*" applies its value to every key of dict1, the values from dict1
+  # taking precedence.
+  if "__*" not in dict2:
+    return dict2
+  wildcard = dict2["__*"]
+  dict2 = dict(dict2)
+  dict2.pop("__*")
+  for key in dict1.keys():
+    if isinstance(wildcard, dict):
+      dict2[key] = dict(wildcard)
+      if isinstance(dict1[key], dict):
+        dict2[key].update(dict1[key])
+    else:
+      dict2[key] = wildcard
+  return dict2
+
+def merge_trees(dict1, dict2):
+  # Merges dict2 into dict1 without modifying any of them. Returns the merged
+  # tree, and dict1 with the lists visited by the merge sorted the same way
+  # as in the merged tree, so both can be compared.
+  merged = {}
+  normalized = dict(dict1)
+  stack = [(dict1, dict2, merged, normalized)]
+  while stack:
+    node1, node2, merged_node, normalized_node = stack.pop()
+    node2 = expand_wildcard(node1, node2)
+    for k in list(node1.keys()) + [k for k in node2.keys() if k not in node1]:
+      if k in node1 and k in node2:
+        if isinstance(node1[k], dict) and isinstance(node2[k], dict):
+          merged_node[k] = {}
+          normalized_node[k] = dict(node1[k])
+          stack.append((node1[k], node2[k], merged_node[k], normalized_node[k]))
+        elif isinstance(node1[k], list) and isinstance(node2[k], list):
+          merged_node[k], normalized_node[k] = merge_lists(node1[k], node2[k])
+        else:
+          # If one of the values is not a dict, you can't continue merging it.
+          # Value from second dict overrides one in first and we move on.
+          merged_node[k] = node2[k]
+      elif k in node1:
+        merged_node[k] = node1[k]
+      else:
+        merged_node[k] = node2[k]
+  return merged, normalized
+
+def mergedicts(dict1, dict2):
+  merged, normalized = merge_trees(dict1, dict2)
+  yield from merged.items()
+
+def match_partial(expected, generated, limit=None):
+  # Key paths where generated does not contain expected, with the rules of
+  # merge_trees(): the keys must exist with equal values, the items of the
+  # lists must be items of the generated lists, and "__*" applies to every
+  # key. Only the expected keys are visited, nothing is copied.
+  mismatches = []
+  stack = [((), expected, generated)]
+  while stack:
+    path, node2, node1 = stack.pop()
+    node2 = expand_wildcard(node1, node2)
+    children = []
+    for k in node2:
+      if k not in node1:
+        mismatches.append(path + (k,))
+      elif isinstance(node1[k], dict) and isinstance(node2[k], dict):
+        children.append((path + (k,), node2[k], node1[k]))
+      elif isinstance(node1[k], list) and isinstance(node2[k], list):
+        merged, normalized = merge_lists(node1[k], node2[k])
+        if merged != normalized:
+          mismatches.append(path + (k,))
+      elif node1[k] != node2[k]:
+        mismatches.append(path + (k,))
+      if limit and len(mismatches) >= limit:
+        return mismatches
+    stack.extend(reversed(children))
+  return mismatches
+
+def match_absent(expected, generated, limit=None):
+  # Key paths of expected found in generated: the keys set to None must not
+  # exist, in a dict or as an item of a list, and the other values must
+  # differ. Only the expected keys are visited, nothing is copied.
+  mismatches = []
+  stack = [((), expected, generated)]
+  while stack:
+    path, needle, haystack = stack.pop()
+    children = []
+    for key, value in needle.items():
+      if not isinstance(haystack, (dict, list)) or key not in haystack:
+        continue
+      if value is None:
+        mismatches.append(path + (key,))
+      elif isinstance(value, dict) and isinstance(haystack, dict):
+        children.append((path + (key,), value, haystack[key]))
+      elif isinstance(haystack, dict) and haystack[key] == value:
+        mismatches.append(path + (key,))
+      if limit and len(mismatches) >= limit:
+        return mismatches
+    stack.extend(reversed(children))
+  return mismatches
+
+def without_paths(data, paths):
+  # Copy of data without the given key paths, only the containers on the
+  # paths are copied
+  data = copy.copy(data)
+  for path in paths:
+    node = data
+    for key in path[:-1]:
+      node[key] = copy.copy(node[key])
+      node = node[key]
+    if isinstance(node, dict):
+      node.pop(path[-1], None)
+    elif isinstance(node, list):
+      node[:] = [item for item in node if item != path[-1]]
+  return data
+
+# In auto mode, outputs up to this number of nodes get a unified text diff
+text_diff_max_nodes = 1000
+tree_diff_max_differences = 100
+tree_diff_max_value_length = 120
+jsonpath_plain_key = re.compile(r"^[A-Za-z_][A-Za-z0-9_-]*$")
+
+def tree_size(data, limit):
+    size = 0
+    stack = [data]
+    while stack and size <= limit:
+        node = stack.pop()
+        size += 1
+        if isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return size
+
+def jsonpath_child(path, key, list_index=False):
+    if list_index:
+        key = "[{}]".format(key)
+    elif jsonpath_plain_key.match(str(key)):
+        key = str(key)
+    else:
+        key = "'{}'".format(str(key).replace("'", "\\'"))
+    if not path:
+        return key
+    return "{}.{}".format(path, key)
+
+def format_key_path(path):
+    formatted = ""
+    for key in path:
+        formatted = jsonpath_child(formatted, key)
+    return formatted or "$"
+
+def list_opcodes(expected, generated):
+    # Aligns the items of two lists, so an inserted item is reported once
+    # instead of shifting every following index
+    try:
+        matcher = difflib.SequenceMatcher(
+            None,
+            [canonical_key(item) for item in expected],
+            [canonical_key(item) for item in generated],
+        )
+        return matcher.get_opcodes()
+    except TypeError:
+        return [("replace", 0, len(expected), 0, len(generated))]
+
+def iter_tree_diff(expected, generated):
+    # Walks both trees and yields the differences in the key order, as
+    # (operation, JSONPath, expected value, generated value) tuples.
+    stack = [("compare", "", expected, generated)]
+    while stack:
+        operation, path, expected, generated = stack.pop()
+        if operation != "compare":
+            yield (operation, path, expected, generated)
+        elif isinstance(expected, dict) and isinstance(generated, dict):
+            children = []
+            for key in sorted(set(expected) | set(generated), key=str):
+                child_path = jsonpath_child(path, key)
+                if key not in generated:
+                    children.append(("removed", child_path, expected[key], None))
+                elif key not in expected:
+                    children.append(("added", child_path, None, generated[key]))
+                else:
+                    children.append(("compare", child_path, expected[key], generated[key]))
+            stack.extend(reversed(children))
+        elif isinstance(expected, list) and isinstance(generated, list):
+            children = []
+            for tag, expected_start, expected_end, generated_start, generated_end in list_opcodes(expected, generated):
+                if tag == "equal":
+                    continue
+                paired = min(expected_end - expected_start, generated_end - generated_start)
+                for offset in range(paired):
+                    children.append((
+                        "compare",
+                        jsonpath_child(path, generated_start + offset, list_index=True),
+                        expected[expected_start + offset],
+                        generated[generated_start + offset],
+                    ))
+                for index in range(expected_start + paired, expected_end):
+                    children.append(("removed", jsonpath_child(path, index, list_index=True), expected[index], None))
+                for index in range(generated_start + paired, generated_end):
+                    children.append(("added", jsonpath_child(path, index, list_index=True), None, generated[index]))
+            stack.extend(reversed(children))
+        elif expected != generated:
+            yield ("changed", path or "$", expected, generated)
+
+def short_value(value):
+    # The value is encoded lazily, so only its beginning is encoded when it is large
+    text = ""
+    for chunk in json.JSONEncoder(default=str).iterencode(value):
+        text += chunk
+        if len(text) > tree_diff_max_value_length:
+            return text[:tree_diff_max_value_length - 3] + "..."
+    return text
+
+def tree_diff(expected, generated):
+    # Structural diff of the failed tests, with lines starting with -/+ like
+    # a unified diff
+    lines = ["--- expected\n", "+++ generated\n"]
+    count = 0
+    for operation, path, expected_value, generated_value in iter_tree_diff(expected, generated):
+        count += 1
+        if count > tree_diff_max_differences:
+            continue
+        if operation != "added":
+            lines.append("-{}: {}\n".format(path, short_value(expected_value)))
+        if operation != "removed":
+            lines.append("+{}: {}\n".format(path, short_value(generated_value)))
+    if count > tree_diff_max_differences:
+        lines.append("... {} more differences\n".format(count - tree_diff_max_differences))
+    return lines
+
+def relative_output_path(path):
+    # path relative to the current directory, without the leading "/" and
+    # ".." parts, so it can only name a file under the write directory
+    if os.path.isabs(path):
+        path = os.path.relpath(path)
+    parts = os.path.normpath(path).split(os.sep)
+    while parts and parts[0] in ("", os.curdir, os.pardir):
+        parts.pop(0)
+    return os.path.join(*parts) if parts else ""
+
+def output_path(testfile, target, case=None):
+    # One generated file per test file, target template and matrix case
+    path = os.path.splitext(relative_output_path(testfile))[0]
+    if case is not None:
+        path = os.path.join(path, re.sub(r"[^A-Za-z0-9_.=-]+", "_", case))
+    return os.path.join(path, relative_output_path(target))
+
+def in_output_dir(dirname, filename):
+    # The symbolic links are followed, a generated file is never written or
+    # removed outside of the write directory
+    directory = os.path.realpath(dirname)
+    path = os.path.realpath(os.path.join(dirname, filename))
+    return os.path.commonpath([directory, path]) == directory and path != directory
+
+def load_output_manifest(dirname):
+    try:
+        return json.load(open(os.path.join(dirname, "manifest.json"), 'r', encoding="utf-8"))['files']
+    except Exception:
+        return {}
+
+class OutputWriter():
+    # Writes the generated files of --write-dir from a background thread,
+    # skipping the files whose content did not change since the last run.
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.previous_files = load_output_manifest(dirname)
+        self.created_dirs = set()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, content = item
+                directory = os.path.dirname(path)
+                if directory not in self.created_dirs:
+                    os.makedirs(directory, exist_ok=True)
+                    self.created_dirs.add(directory)
+                f = open(path + ".tmp", 'w', encoding="utf-8")
+                f.write(content)
+                f.close()
+                os.replace(path + ".tmp", path)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def write(self, filename, content):
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        previous = self.previous_files.get(filename)
+        path = os.path.join(self.dirname, filename)
+        if previous is None or previous['sha256'] != digest or not os.path.exists(path):
+            self.queue.put((path, content))
+        return digest
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+output_writers = {}
+
+def write_output(dirname, testfile, target, case, content):
+    if dirname not in output_writers:
+        output_writers[dirname] = OutputWriter(dirname)
+    filename = output_path(testfile, target, case)
+    if not in_output_dir(dirname, filename):
+        print("Error: not writing the output {} outside of {}".format(filename, dirname))
+        return None
+    return {'path': filename, 'sha256': output_writers[dirname].write(filename, content)}
+
+def flush_outputs():
+    for writer in output_writers.values():
+        writer.flush()
+
+def close_outputs():
+    for writer in output_writers.values():
+        writer.close()
+    output_writers.clear()
+
+def write_output_manifest(dirname, ran_tests, records):
+    # The previous entries of the tests which did not run are kept, the
+    # outputs the tests which ran no longer generate are removed
+    files = {}
+    for filename, entry in load_output_manifest(dirname).items():
+        if entry['test'] not in ran_tests:
+            files[filename] = entry
+    for record in records:
+        if record.get('output'):
+            files[record['output']['path']] = {
+                'test': record['test'],
+                'target': record['target'],
+                'case': record['case'],
+                'sha256': record['output']['sha256'],
+            }
+    for filename, entry in load_output_manifest(dirname).items():
+        if filename not in files and in_output_dir(dirname, filename):
+            try:
+                os.remove(os.path.join(dirname, filename))
+            except OSError:
+                pass
+    f = open(os.path.join(dirname, "manifest.json.tmp"), 'w', encoding="utf-8")
+    json.dump({'files': files}, f, indent=1, sort_keys=True)
     f.close()
+    os.replace(os.path.join(dirname, "manifest.json.tmp"), os.path.join(dirname, "manifest.json"))
+
+# Execution module functions of the __call variables, imported once per run
+salt_module_functions = {}
+
+def salt_module_function(name):
+    if name not in salt_module_functions:
+        try:
+            module = importlib.import_module("salt.modules.{}".format(name.split('.')[0]))
+            salt_module_functions[name] = getattr(module, name.split('.')[1])
+        except Exception:
+            salt_module_functions[name] = None
+    return salt_module_functions[name]
+
+def salt_stub_functions(context):
+    # Side effect free stand-ins of the common execution module functions,
+    # reading the variables of the test
+    def grains():
+        return context.get('__grains__', context.get('grains', {}))
+
+    def pillar_get(key, default='', merge=False, merge_nested_lists=None, delimiter=':', **kwargs):
+        return salt.utils.data.traverse_dict_and_list(context.get('pillar', {}), key, default, delimiter)
+
+    def grains_get(key, default='', delimiter=':', **kwargs):
+        return salt.utils.data.traverse_dict_and_list(grains(), key, default, delimiter)
+
+    def config_get(key, default='', delimiter=':', **kwargs):
+        for data in [context.get('opts', {}), grains(), context.get('pillar', {})]:
+            value = salt.utils.data.traverse_dict_and_list(data, key, salt_stub_functions, delimiter)
+            if value is not salt_stub_functions:
+                return value
+        return default
+
+    def cmd_run(cmd, *args, **kwargs):
+        return ""
+
+    return {
+        'pillar.get': pillar_get,
+        'pillar.items': lambda *args, **kwargs: context.get('pillar', {}),
+        'grains.get': grains_get,
+        'grains.items': lambda *args, **kwargs: grains(),
+        'config.get': config_get,
+        'cmd.run': cmd_run,
+        'cmd.run_stdout': cmd_run,
+        'cmd.shell': cmd_run,
+        'cmd.retcode': lambda *args, **kwargs: 0,
+    }
 
 class SaltObject():
-    callables = {}
-    modules = {}
-    def __call__(self, *args, **kwargs):
-        funcname = args[0]
-        if funcname in self.callables:
-            return self.callables[funcname]
-        if args[1] != None:
-            return args[1]
-        return None
+    # The salt / __salt__ variable of the templates. The functions are
+    # resolved once, at the first lookup: the __call execution modules, then
+    # the values injected by the salt variable, then the stubs.
+    def __init__(self, callables=None):
+        self.callables = callables or {}
+        self.modules = {}
+        self.context = {}
+        self.functions = None
+
+    def __getstate__(self):
+        # Only the injected values are shown by the verbose mode
+        if self.callables:
+            return {'callables': self.callables}
+        return {}
+
+    def __call__(self, key, default=None, *args, **kwargs):
+        if key in self.callables:
+            return self.callables[key]
+        return default
 
     def inject(self, data):
-        # print("injecting")
-        # print(data)
         self.callables = data
+        self.functions = None
 
     def add_call(self, modulename, funcname, **kwargs):
-        # print("call to {}.{} added".format(modulename, funcname), kwargs)
         self.modules[modulename] = {'func': funcname, 'kwargs': kwargs}
+        self.functions = None
+
+    def resolve(self):
+        self.functions = salt_stub_functions(self.context)
+        if isinstance(self.callables, dict):
+            for name, values in self.callables.items():
+                self.functions[name] = SaltObject(values)
+        for name in self.modules:
+            function = salt_module_function(name)
+            if function is not None:
+                self.functions[name] = function
+
+    def __getitem__(self, name):
+        if self.functions is None:
+            self.resolve()
+        return self.functions.get(name)
+
+class CoverageCodeGenerator(jinja2.compiler.CodeGenerator):
+    # jinja only maps the lines holding jinja code to the generated code.
+    # With the coverage, every output node is preceded by a marker listing its
+    # lines of static text, replaced by a counter by CoverageInstrumenter.
+    def visit_Output(self, node, frame):
+        if self.environment.coverage is not None and not frame.require_output_check:
+            lines = set()
+            for child in node.nodes:
+                if isinstance(child, jinja2.nodes.TemplateData):
+                    for offset, text in enumerate(child.data.split("\n")):
+                        if text.strip():
+                            lines.add(child.lineno + offset)
+            if lines:
+                self.writeline(repr(("static_text",) + tuple(sorted(lines))))
+        super().visit_Output(node, frame)
 
-    def __getitem__(self, name, **kwargs):
-        # print("in getitemname", name, "callable", self.callables, "kwargs", kwargs)
-        if name in self.modules:
-            modulename = "salt.modules.{}".format(name.split('.')[0])
+class CachedSandboxedEnvironment(jinja2.sandbox.SandboxedEnvironment):
+    # salt.utils.templates builds a new environment for every render. The
+    # compiled code is shared between all those environments, so a pillar is
+    # lexed, parsed and compiled once per run, and once per cache directory
+    # when the on-disk bytecode cache is enabled.
+    code_cache = {}
+    bytecode_cache_dir = None
+    coverage = None
+    code_generator_class = CoverageCodeGenerator
+
+    def compile_signature(self):
+        return (
+            self.block_start_string, self.block_end_string,
+            self.variable_start_string, self.variable_end_string,
+            self.comment_start_string, self.comment_end_string,
+            self.line_statement_prefix, self.line_comment_prefix,
+            self.trim_blocks, self.lstrip_blocks,
+            self.newline_sequence, self.keep_trailing_newline,
+            self.optimized, repr(self.autoescape),
+            getattr(self.finalize, "__qualname__", repr(self.finalize)),
+            tuple(sorted(self.extensions)),
+        )
+
+    def compile(self, source, name=None, filename=None, raw=False, defer_init=False):
+        if raw or not isinstance(source, str):
+            return super().compile(source, name, filename, raw, defer_init)
+
+        key = (
+            self.compile_signature(),
+            name,
+            filename,
+            defer_init,
+            hashlib.sha256(source.encode("utf-8")).hexdigest(),
+            self.coverage is not None and self.coverage.template_key(filename),
+        )
+        code = self.code_cache.get(key)
+        if code is not None:
+            return code
+
+        if self.coverage is not None:
+            # The instrumented code is not stored on disk, the coverage needs
+            # the lines and branches found while instrumenting.
+            python_source = super().compile(source, name, filename, True, defer_init)
+            tree = self.coverage.instrument(filename, python_source)
+            code = compile(tree, filename or "<template>", "exec")
+            self.code_cache[key] = code
+            return code
+
+        bucket = None
+        if self.bytecode_cache_dir:
+            bytecode_cache = jinja2.bccache.FileSystemBytecodeCache(self.bytecode_cache_dir)
+            cache_name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+            bucket = bytecode_cache.get_bucket(self, cache_name, None, source)
+            code = bucket.code
+
+        if code is None:
+            code = super().compile(source, name, filename, raw, defer_init)
+            if bucket is not None:
+                bucket.code = code
+                bytecode_cache.set_bucket(bucket)
+
+        self.code_cache[key] = code
+        return code
+
+def enable_caches(cache_dir=""):
+    global yaml_cache_dir
+    if cache_dir:
+        bytecode_cache_dir = os.path.join(cache_dir, "jinja")
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        CachedSandboxedEnvironment.bytecode_cache_dir = bytecode_cache_dir
+        yaml_cache_dir = os.path.join(cache_dir, "yaml")
+        os.makedirs(yaml_cache_dir, exist_ok=True)
+    else:
+        CachedSandboxedEnvironment.bytecode_cache_dir = None
+        yaml_cache_dir = None
+    # render_jinja_tmpl() instanciates jinja2.sandbox.SandboxedEnvironment
+    # with the salt filters, tests and extensions, use ours instead.
+    jinja2.sandbox.SandboxedEnvironment = CachedSandboxedEnvironment
+
+glob_magic = re.compile('[*?[]')
+
+class FileIndex():
+    # Listing of the pillar and test trees made with one os.scandir() per
+    # directory, the globs of the tests are matched against it instead of
+    # listing the directories again for every test. A previous index is
+    # reused for the directories whose mtime did not change, except the ones
+    # modified less than racy_delay before it was made.
+    racy_delay = 2 * 10**9
+
+    def __init__(self, roots, previous=None):
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.scanned = time.time_ns()
+        # directory: (mtime, subdirectories, files, symlinks)
+        self.dirs = {}
+        reused = {}
+        if previous is not None:
+            reused = dict(
+                (path, entry) for path, entry in previous.dirs.items()
+                if entry[0] < previous.scanned - self.racy_delay
+            )
+
+        to_visit = [(root, frozenset()) for root in self.roots]
+        while to_visit:
+            path, ancestors = to_visit.pop()
             try:
-                # print("trying to import {}".format(modulename))
-                r = importlib.import_module(modulename)
-                # print(type(r))
-                # print(r, name)
-                func = r.__getattribute__(name.split('.')[1])
-                # print("got func", func)
-                return func
-            except Exception:
-                return self.callables[funcname]()
-        # else:
-        #     print("name not in self.modules", namedtuple)
-
-        if name in self.callables:
-            r = SaltObject()
-            r.inject(self.callables[name])
-            return r
-            #print(name, "not in", self.callables)
-        # else:
-        #     print("name not in self.callables", name)
+                st = os.stat(path)
+            except OSError:
+                continue
+            # Symlinks to a parent directory would loop forever
+            if not os.path.isdir(path) or (st.st_dev, st.st_ino) in ancestors:
+                continue
+            entry = reused.get(path)
+            if entry is None or entry[0] != st.st_mtime_ns:
+                entry = self.scan(path, st.st_mtime_ns)
+            self.dirs[path] = entry
+            ancestors = ancestors | {(st.st_dev, st.st_ino)}
+            to_visit.extend((os.path.join(path, name), ancestors) for name in entry[1])
+        self.paths = set(
+            os.path.join(path, name) for path, entry in self.dirs.items() for name in entry[1] + entry[2]
+        )
+
+    def scan(self, path, mtime):
+        subdirs, files, links = [], [], set()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+                    if entry.is_symlink():
+                        links.add(entry.name)
+        except OSError:
+            pass
+        return (mtime, sorted(subdirs), sorted(files), links)
+
+    def root_parts(self, pattern):
+        # The root containing the pattern and the parts of the pattern below
+        # it, None for the patterns that glob.glob() must resolve
+        if os.path.isabs(pattern) or "//" in pattern or pattern.endswith("/"):
+            return None
+        parts = pattern.split("/")
+        if "." in parts or ".." in parts:
+            return None
+        for root in self.roots:
+            root_parts = root.split("/")
+            if parts[:len(root_parts)] == root_parts and len(parts) > len(root_parts):
+                return root, parts[len(root_parts):]
         return None
 
-def run_tests(f, config, outputdir=""):
+    def match(self, names, part):
+        matching = fnmatch.filter(names, part)
+        if part.startswith("."):
+            return matching
+        return [name for name in matching if not name.startswith(".")]
+
+    def descendants(self, path):
+        # The directory and its subdirectories like the ** of glob
+        paths = []
+        to_visit = [path]
+        while to_visit:
+            path = to_visit.pop()
+            if path not in self.dirs:
+                continue
+            paths.append(path)
+            to_visit.extend(os.path.join(path, name) for name in self.dirs[path][1] if not name.startswith("."))
+        return paths
+
+    def glob(self, pattern, recursive=False):
+        resolved = self.root_parts(pattern)
+        if resolved is None or (recursive and resolved[1][-1] == "**"):
+            return sorted(glob.glob(pattern, recursive=recursive))
+        root, parts = resolved
+
+        directories = [root]
+        for part in parts[:-1]:
+            matching = []
+            for directory in directories:
+                if directory not in self.dirs:
+                    continue
+                if recursive and part == "**":
+                    matching += self.descendants(directory)
+                elif glob_magic.search(part):
+                    matching += [os.path.join(directory, name) for name in self.match(self.dirs[directory][1], part)]
+                elif part in self.dirs[directory][1]:
+                    matching.append(os.path.join(directory, part))
+            directories = matching
+
+        part = parts[-1]
+        paths = []
+        for directory in directories:
+            if directory not in self.dirs:
+                continue
+            if glob_magic.search(part):
+                names = self.dirs[directory][2] + self.dirs[directory][1]
+                paths += [os.path.join(directory, name) for name in self.match(names, part)]
+            elif os.path.join(directory, part) in self.paths:
+                paths.append(os.path.join(directory, part))
+        return sorted(set(paths))
+
+    def islink(self, path):
+        directory, name = os.path.split(os.path.normpath(path))
+        if directory not in self.dirs:
+            return os.path.islink(path)
+        return name in self.dirs[directory][3]
+
+file_index = None
+
+def index_files(roots, cache_dir=""):
+    # Indexes the trees, reusing the index of the previous run of a server or
+    # watch, or the one saved in the cache directory
+    global file_index
+    roots = [os.path.normpath(root) for root in roots]
+    index_path = os.path.join(cache_dir, "file-index.pickle") if cache_dir else None
+    previous = file_index
+    if previous is None and index_path and os.path.exists(index_path):
+        try:
+            with open(index_path, 'rb') as f:
+                previous = pickle.load(f)
+        except Exception:
+            previous = None
+    if previous is not None and getattr(previous, 'roots', None) != roots:
+        previous = None
+
+    file_index = FileIndex(roots, previous)
+    if index_path:
+        # Parallel runs sharing the cache directory write their own file
+        temporary_path = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(file_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, index_path)
+    return file_index
+
+def index_glob(pattern, recursive=False):
+    if file_index is None:
+        return glob.glob(pattern, recursive=recursive)
+    return file_index.glob(pattern, recursive=recursive)
+
+def index_islink(path):
+    if file_index is None:
+        return os.path.islink(path)
+    return file_index.islink(path)
+
+class CoverageInstrumenter(ast.NodeTransformer):
+    # Adds hit counters to the python code generated by jinja: one before the
+    # code of every template line, one for the static text of every output
+    # marked by CoverageCodeGenerator, and one at the start of both branches of
+    # every {% if %} / {% elif %}.
+    def __init__(self, key, line_map):
+        self.key = key
+        self.line_map = line_map
+        self.code_lines = set(line_map.values())
+        self.lines = set()
+        self.branches = set()
+
+    def counter(self, method, location, *args):
+        call = ast.Expr(ast.Call(
+            func=ast.Attribute(
+                value=ast.Attribute(value=ast.Name(id="environment", ctx=ast.Load()), attr="coverage", ctx=ast.Load()),
+                attr=method,
+                ctx=ast.Load()
+            ),
+            args=[ast.Constant(self.key)] + [ast.Constant(arg) for arg in args],
+            keywords=[]
+        ))
+        return ast.copy_location(call, location)
+
+    def static_text_lines(self, statement):
+        # The lines holding jinja code have their own counter
+        if isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Tuple):
+            marker = ast.literal_eval(statement.value)
+            if marker and marker[0] == "static_text":
+                return tuple(line for line in marker[1:] if line not in self.code_lines)
+        return None
+
+    def instrument_body(self, body):
+        instrumented = []
+        previous_line = None
+        for statement in body:
+            static_text_lines = self.static_text_lines(statement)
+            if static_text_lines is not None:
+                if static_text_lines:
+                    self.lines.update(static_text_lines)
+                    instrumented.append(self.counter("hit_lines", statement, static_text_lines))
+                continue
+            line = self.line_map.get(statement.lineno)
+            if line is not None and line != previous_line:
+                self.lines.add(line)
+                instrumented.append(self.counter("hit", statement, line))
+                previous_line = line
+            instrumented.append(statement)
+        return instrumented
+
+    def generic_visit(self, node):
+        super().generic_visit(node)
+        for field in ("body", "orelse", "finalbody"):
+            statements = getattr(node, field, None)
+            if statements and isinstance(statements, list) and isinstance(statements[0], ast.stmt):
+                setattr(node, field, self.instrument_body(statements))
+        if isinstance(node, ast.If) and node.lineno in self.line_map:
+            line = self.line_map[node.lineno]
+            self.branches.add((line, "then"))
+            self.branches.add((line, "else"))
+            node.body.insert(0, self.counter("branch", node, line, "then"))
+            node.orelse.insert(0, self.counter("branch", node, line, "else"))
+        return node
+
+class TemplateCoverage():
+    # Line and branch coverage of the templates, collected by the counters
+    # of CoverageInstrumenter. The templates rendered from a string have no
+    # name, they are known by the current_filename set before rendering.
+    def __init__(self):
+        self.current_filename = None
+        self.lines = {}
+        self.branches = {}
+        self.line_hits = collections.Counter()
+        self.branch_hits = collections.Counter()
+        self.new_keys = set()
+
+    def hit(self, key, line):
+        self.line_hits[key, line] += 1
+
+    def hit_lines(self, key, lines):
+        for line in lines:
+            self.line_hits[key, line] += 1
+
+    def branch(self, key, line, arm):
+        self.branch_hits[key, line, arm] += 1
+
+    def template_key(self, filename):
+        return os.path.normpath(filename or self.current_filename or "<template>")
+
+    def instrument(self, filename, python_source):
+        key = self.template_key(filename)
+        debug_info = re.search(r"^debug_info = '(.*)'$", python_source, re.MULTILINE)
+        line_map = {}
+        if debug_info and debug_info.group(1):
+            for pair in debug_info.group(1).split("&"):
+                template_line, code_line = pair.split("=")
+                line_map[int(code_line)] = int(template_line)
+        instrumenter = CoverageInstrumenter(key, line_map)
+        tree = ast.fix_missing_locations(instrumenter.visit(ast.parse(python_source)))
+        self.lines[key] = instrumenter.lines
+        self.branches[key] = instrumenter.branches
+        self.new_keys.add(key)
+        return tree
+
+    def pop_data(self):
+        # Coverage collected since the previous call, by file name, in the
+        # format of the json report so it can be merged with merge_coverage().
+        keys = set(self.new_keys)
+        keys |= set(key for key, line in self.line_hits)
+        keys |= set(key for key, line, arm in self.branch_hits)
+        data = {}
+        for key in keys:
+            data[key] = {
+                'lines': dict(
+                    (str(line), self.line_hits[key, line]) for line in self.lines.get(key, ())
+                ),
+                'branches': dict(
+                    ("{}:{}".format(line, arm), self.branch_hits[key, line, arm])
+                    for line, arm in self.branches.get(key, ())
+                ),
+            }
+        self.line_hits.clear()
+        self.branch_hits.clear()
+        self.new_keys.clear()
+        return data
+
+def merge_coverage(coverage_data, other_coverage_data):
+    for filename, file_data in other_coverage_data.items():
+        merged = coverage_data.setdefault(filename, {'lines': {}, 'branches': {}})
+        for kind in ('lines', 'branches'):
+            for item, count in file_data[kind].items():
+                merged[kind][item] = merged[kind].get(item, 0) + count
+    return coverage_data
+
+def coverage_ratio(counts):
+    covered = len([count for count in counts.values() if count])
+    return covered, len(counts)
+
+def coverage_percent(covered, total):
+    if not total:
+        return 100.0
+    return round((100 * covered) / total, 2)
+
+def coverage_page_name(filename):
+    return filename.replace(os.sep, "_") + ".html"
+
+def write_coverage_report(directory, coverage_data):
+    os.makedirs(directory, exist_ok=True)
+    f = open(os.path.join(directory, "coverage.json"), 'w', encoding="utf-8")
+    json.dump({'files': coverage_data}, f, indent=1, sort_keys=True)
+    f.close()
+
+    style = (
+        "<style>body{font-family:monospace} td{padding:0 .5em} .hit{background:#cfc}"
+        " .miss{background:#fcc} .partial{background:#ffc}</style>"
+    )
+    rows = []
+    for filename in sorted(coverage_data):
+        file_data = coverage_data[filename]
+        lines_covered, lines_total = coverage_ratio(file_data['lines'])
+        branches_covered, branches_total = coverage_ratio(file_data['branches'])
+        rows.append("<tr><td><a href=\"{}\">{}</a></td><td>{}/{} ({}%)</td><td>{}/{} ({}%)</td></tr>".format(
+            html.escape(coverage_page_name(filename)), html.escape(filename),
+            lines_covered, lines_total, coverage_percent(lines_covered, lines_total),
+            branches_covered, branches_total, coverage_percent(branches_covered, branches_total),
+        ))
+
+        try:
+            source_lines = open(filename, 'r', encoding="utf-8").read().splitlines()
+        except OSError:
+            source_lines = []
+        source_rows = []
+        for number, source_line in enumerate(source_lines, start=1):
+            arms = dict(
+                (item.split(":")[1], count) for item, count in file_data['branches'].items()
+                if item.split(":")[0] == str(number)
+            )
+            if str(number) not in file_data['lines']:
+                css = ""
+            elif not file_data['lines'][str(number)]:
+                css = "miss"
+            elif arms and not all(arms.values()):
+                css = "partial"
+            else:
+                css = "hit"
+            source_rows.append("<tr class=\"{}\"><td>{}</td><td>{}</td><td>{}</td><td><pre>{}</pre></td></tr>".format(
+                css,
+                number,
+                file_data['lines'].get(str(number), ""),
+                " ".join("{}: {}".format(arm, count) for arm, count in sorted(arms.items())),
+                html.escape(source_line),
+            ))
+        f = open(os.path.join(directory, coverage_page_name(filename)), 'w', encoding="utf-8")
+        f.write("<html><head><title>{0}</title>{1}</head><body><h1>{0}</h1><table>{2}</table></body></html>".format(
+            html.escape(filename), style, "".join(source_rows)
+        ))
+        f.close()
+
+    f = open(os.path.join(directory, "index.html"), 'w', encoding="utf-8")
+    f.write("<html><head><title>Template coverage</title>{}</head><body><h1>Template coverage</h1>"
+            "<table><tr><th>File</th><th>Lines</th><th>Branches</th></tr>{}</table></body></html>".format(
+        style, "".join(rows)
+    ))
+    f.close()
+
+def print_coverage_summary(coverage_data):
+    lines_covered = lines_total = branches_covered = branches_total = 0
+    for file_data in coverage_data.values():
+        covered, total = coverage_ratio(file_data['lines'])
+        lines_covered += covered
+        lines_total += total
+        covered, total = coverage_ratio(file_data['branches'])
+        branches_covered += covered
+        branches_total += total
+    print("Template coverage: {}/{} lines ({}%), {}/{} branches ({}%)".format(
+        lines_covered, lines_total, coverage_percent(lines_covered, lines_total),
+        branches_covered, branches_total, coverage_percent(branches_covered, branches_total),
+    ))
+
+def drop_instrumented_code():
+    # The lines and branches of the instrumented code are only known by the
+    # TemplateCoverage which instrumented it
+    code_cache = CachedSandboxedEnvironment.code_cache
+    for key in [key for key in code_cache if key[-1]]:
+        del code_cache[key]
+
+def enable_coverage():
+    drop_instrumented_code()
+    CachedSandboxedEnvironment.coverage = TemplateCoverage()
+
+def disable_coverage():
+    drop_instrumented_code()
+    CachedSandboxedEnvironment.coverage = None
+
+def seed_coverage(coverage_data, config):
+    # The templates rendered by no test are in the report too, with all their
+    # lines missed
+    coverage = CachedSandboxedEnvironment.coverage
+    environment = CachedSandboxedEnvironment(
+        extensions=["jinja2.ext.do", "jinja2.ext.loopcontrols", salt.utils.jinja.SerializerExtension]
+    )
+    for pillar_file in testable_pillar_files(config):
+        key = coverage.template_key(pillar_file)
+        if key in coverage_data:
+            continue
+        try:
+            source = open(pillar_file, 'r', encoding="utf-8").read()
+            coverage.instrument(key, environment.compile(source, filename=key, raw=True))
+        except (OSError, UnicodeDecodeError, jinja2.TemplateSyntaxError):
+            coverage_data[key] = {'lines': {}, 'branches': {}}
+    return merge_coverage(coverage_data, coverage.pop_data())
+
+assertion_kinds = [
+    'expected',
+    'content',
+    'content_partial',
+    'expected_partial',
+    'expected_absent',
+    'check_list',
+    'check_string',
+    'check_int',
+    'check_bool',
+]
+
+# Conditions of the check_* assertions, by order of precedence
+assertion_conditions = {
+    'check_list': ['morethan', 'equalto', 'lessthan'],
+    'check_string': ['notempty', 'stringnotempty', 'contains', 'contains_key', 'equalto'],
+    'check_int': ['equalto', 'greaterthan', 'lowerthan'],
+    'check_bool': ['is'],
+}
+
+class AssertionCheck():
+    def __init__(self, pattern, conditions, known_conditions):
+        self.pattern = pattern
+        self.conditions = conditions
+        self.expression = parse_jsonpath(pattern)
+        self.condition = None
+        self.value = None
+        for condition in known_conditions:
+            if condition in conditions:
+                self.condition = condition
+                self.value = conditions[condition]
+                break
+
+    def find(self, data):
+        return self.expression.find(data)
+
+def set_variable(variables, path, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        if not isinstance(variables.get(key), dict):
+            variables[key] = {}
+        variables = variables[key]
+    variables[keys[-1]] = value
+
+def matrix_error(test_data_yaml):
+    # Why the matrix of a test file can not be expanded, None if it can
+    if 'matrix' not in test_data_yaml:
+        return None
+    if not isinstance(test_data_yaml['matrix'], dict) or not test_data_yaml['matrix']:
+        return "matrix must be a mapping of variables to lists of values"
+    for axis, axis_values in test_data_yaml['matrix'].items():
+        if not isinstance(axis_values, list) or not axis_values:
+            return "matrix axis {} must be a non-empty list of values".format(axis)
+    return None
+
+def expand_matrix(test_data_yaml):
+    # The cases of a test file: (label, test data) for every combination of
+    # the values of the matrix axes, or the test file itself without matrix
+    if 'matrix' not in test_data_yaml:
+        return [(None, test_data_yaml)]
+    axes = list(test_data_yaml['matrix'].items())
+    variables = pickle.dumps(test_data_yaml.get('variables') or {})
+    cases = []
+    for values in itertools.product(*[axis_values for axis, axis_values in axes]):
+        case_values = dict((axis, value) for (axis, axis_values), value in zip(axes, values))
+        case_data = dict(test_data_yaml)
+        case_data['variables'] = pickle.loads(variables)
+        for axis, value in case_values.items():
+            set_variable(case_data['variables'], axis, value)
+        # The assertion of the first matching matrix_cases entry replaces the
+        # assertion of the test file
+        for case in test_data_yaml.get('matrix_cases', []):
+            if all(case_values.get(axis) == value for axis, value in case.get('when', {}).items()):
+                for kind in assertion_kinds:
+                    case_data.pop(kind, None)
+                for kind in assertion_kinds:
+                    if kind in case:
+                        case_data[kind] = case[kind]
+                break
+        label = ", ".join(
+            "{}={}".format(axis, value if isinstance(value, str) else json.dumps(value, default=str))
+            for axis, value in case_values.items()
+        )
+        cases.append((label, case_data))
+    return cases
+
+class AssertionPlan():
+    # What a test file asserts, compiled once and run against every
+    # template matched by its file: glob.
+    def __init__(self, test_data_yaml):
+        self.kind = None
+        self.checks = []
+        for kind in assertion_kinds:
+            if kind in test_data_yaml:
+                self.kind = kind
+                break
+        if self.kind in assertion_conditions:
+            for pattern, conditions in test_data_yaml[self.kind].items():
+                self.checks.append(AssertionCheck(pattern, conditions, assertion_conditions[self.kind]))
+
+memory_base = 0
+
+def reset_memory_peak():
+    global memory_base
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        memory_base = tracemalloc.get_traced_memory()[0]
+
+def memory_peak():
+    # Peak of the memory allocated since the last call, when --profile
+    # traces the allocations.
+    if not tracemalloc.is_tracing():
+        return None
+    peak = tracemalloc.get_traced_memory()[1] - memory_base
+    reset_memory_peak()
+    return peak
+
+def test_record(testfile, target, status, reason=None, kind=None, diff=None, durations=None, case=None, output=None):
+    # One result of a test file against one of its target templates, as
+    # written in the --report files.
+    durations = durations or {}
+    record = {
+        'test': testfile,
+        'target': target,
+        'case': case,
+        'kind': kind,
+        'status': status,
+        'reason': reason,
+        'diff': diff,
+        'duration': round(sum(durations.values()), 6),
+        'durations': dict((phase, round(duration, 6)) for phase, duration in durations.items()),
+    }
+    if output is not None:
+        record['output'] = output
+    peak_memory = memory_peak()
+    if peak_memory is not None:
+        record['peak_memory'] = peak_memory
+    return record
+
+def target_error_record(testfile, target, kind, durations, case):
+    # Prints the exception being handled, and returns the error record of the
+    # target with its traceback as reason
+    reason = traceback.format_exc()
+    print(reason.rstrip())
+    return test_record(testfile, target, "error", reason, kind, durations=durations, case=case)
+
+def run_tests(f, config, outputdir="", records=None, targets=None):
+    if records is None:
+        records = []
     if sys.version_info.major >= 3 and sys.version_info.minor >= 6:
         current_dt = datetime.datetime.now().isoformat(timespec='microseconds')
     else:
         current_dt = datetime.datetime.now().isoformat()
     print("[{}] Parsing {} ...".format(current_dt, f.name))
+    reset_memory_peak()
+    # The parse and glob times of the test file are counted in its first target
+    file_durations = {}
+    started = time.perf_counter()
     test_data = f.read()
-    test_data_yaml = yaml.load(test_data, Loader = yaml.SafeLoader)
+    test_data_yaml = load_yaml_cached(test_data)
+    file_durations['parse'] = time.perf_counter() - started
+
+    if not test_data_yaml:
+        print("Error: Test file {} is empty.".format(f.name))
+        records.append(test_record(f.name, None, "error", "Test file is empty", durations=file_durations))
+        return(1)
+
+    started = time.perf_counter()
+    if 'stack' in test_data_yaml:
+        # The whole stack is a single target
+        target_template_filenames = [", ".join(stack_config_files(test_data_yaml['stack']))]
+    else:
+        target_template_filenames = sorted(index_glob(test_data_yaml['file']))
+    file_durations['glob'] = time.perf_counter() - started
+
+    if len(target_template_filenames) == 0:
+        print("{} does not match a file".format(test_data_yaml['file']))
+        records.append(test_record(
+            f.name, None, "error", "{} does not match a file".format(test_data_yaml['file']), durations=file_durations
+        ))
+        return(1)
+
+    excluded_files = []
+    if "file_exclude" in test_data_yaml:
+        started = time.perf_counter()
+        excluded_files = sorted(index_glob(test_data_yaml["file_exclude"]))
+        file_durations['glob'] += time.perf_counter() - started
+        for excluded_file in excluded_files:
+            print("{} skipping {} ...".format(" "*28, excluded_file))
+
+        target_template_filenames = set(target_template_filenames) - set(excluded_files)
+
+    if targets is not None:
+        target_template_filenames = [filename for filename in target_template_filenames if filename in targets]
+
+    reason = matrix_error(test_data_yaml)
+    if reason is not None:
+        print("Error: {}".format(reason))
+        records.append(test_record(f.name, None, "error", reason, durations=file_durations))
+        return(1)
+
+    started = time.perf_counter()
+    # Every case of a matrix test is run like a test file of its own
+    cases = []
+    for case_label, case_data in expand_matrix(test_data_yaml):
+        cases.append((case_label, case_data, AssertionPlan(case_data)))
+    file_durations['parse'] += time.perf_counter() - started
+    main_return_value = 0
+
+    previous_target_template_filename = None
+    for target_template_filename in target_template_filenames:
+        for case_label, test_data_yaml, plan in cases:
+            durations = file_durations
+            file_durations = {}
+            output = None
+            started = time.perf_counter()
+            target_label = target_template_filename
+            if case_label is not None:
+                target_label = "{} [{}]".format(target_template_filename, case_label)
+            if 'file' in test_data_yaml and target_template_filename != test_data_yaml['file'] \
+                    and target_template_filename != previous_target_template_filename:
+                print("{} against {} ...".format(" "*28, target_template_filename))
+            if case_label is not None:
+                print("{} case {} ...".format(" "*28, case_label))
+            variables_digest = None
+            if 'stack' in test_data_yaml:
+                variables_digest = hashlib.sha256(pickle.dumps(test_data_yaml['variables'])).digest()
+            elif target_template_filename == previous_target_template_filename:
+                # The cases of a matrix test share the template
+                pass
+            elif 'file' in test_data_yaml:
+                try:
+                    target_template_file = open(target_template_filename, 'r', encoding="utf-8")
+                    target_template_data = target_template_file.read()
+                except Exception as e:
+                    print("Error: File '{}' not found for test file {}".format(test_data_yaml['file'], f.name))
+                    print(e)
+                    records.append(test_record(f.name, target_label, "error", str(e), plan.kind, durations=durations, case=case_label))
+                    return(1)
+            elif 'wrapper' in test_data_yaml:
+                print(test_data_yaml)
+                target_template_data = test_data_yaml['wrapper']
+                print(target_template_data)
+            previous_target_template_filename = target_template_filename
+
+            render_key = None
+            if 'stack' not in test_data_yaml:
+                try:
+                    # The variables are keyed before the salt injections are popped
+                    # from them. The pickle keeps the types and the key order, which
+                    # change the rendering: 0, False and 0.0 render differently.
+                    render_key = (
+                        target_template_filename,
+                        hashlib.sha256(target_template_data.encode("utf-8")).digest(),
+                        hashlib.sha256(pickle.dumps(test_data_yaml['variables'])).digest(),
+                    )
+                except (TypeError, pickle.PicklingError):
+                    pass
+
+            saltobject = SaltObject()
+            context = {
+                'opts': {
+                  'jinja_env': {},
+                  'jinja_sls_env': {},
+                },
+                'sls': {},
+                'saltenv': {},
+                'salt': saltobject,
+                '__salt__': saltobject,
+            }
+            if '__call' in test_data_yaml['variables']:
+                for modulename, funcname in test_data_yaml['variables']['__call'].items():
+                    saltobject.add_call(modulename, funcname)
+                context['__opts__'] = context['opts']
+                globals()['__opts__'] = context['opts']
+            if 'salt' in test_data_yaml['variables']:
+                saltobject.inject(test_data_yaml['variables'].pop('salt'))
+                # print("injected")
+            context.update(test_data_yaml['variables'])
+            saltobject.context = context
+            if verbose:
+                print("### Given:")
+                print(yaml.dump(context, Dumper = yaml_dumper))
+            #print(target_template_data)
+            # print("final context", context, "opts", __opts__)
+
+            if CachedSandboxedEnvironment.coverage is not None:
+                CachedSandboxedEnvironment.coverage.current_filename = target_template_filename
+
+            durations['read'] = time.perf_counter() - started
+            if 'stack' in test_data_yaml:
+                started = time.perf_counter()
+                try:
+                    yaml_from_template = render_stack(
+                        stack_config_files(test_data_yaml['stack']),
+                        context,
+                        variables_digest,
+                        test_data_yaml.get('stack_until')
+                    )
+                except Exception:
+                    print("Unable to render the stack {} with the provided variables: {}".format(target_template_filename, context))
+                    durations['render'] = time.perf_counter() - started
+                    main_return_value = 1
+                    records.append(target_error_record(f.name, target_label, plan.kind, durations, case_label))
+                    continue
+                template_data = ""
+                if (plan.kind or "").startswith("content") or outputdir:
+                    template_data = yaml_dump(yaml_from_template)
+                durations['render'] = time.perf_counter() - started
+            elif render_key in render_cache:
+                # Same template and variables as an earlier test, each test gets
+                # its own copy of the parsed output
+                started = time.perf_counter()
+                template_data, yaml_from_template = render_cache[render_key]
+                render_cache.move_to_end(render_key)
+                durations['render'] = time.perf_counter() - started
+                started = time.perf_counter()
+                yaml_from_template = pickle.loads(yaml_from_template)
+                durations['load'] = time.perf_counter() - started
+            else:
+                started = time.perf_counter()
+                try:
+                    template_data = salt.utils.templates.render_jinja_tmpl(tmplstr = target_template_data, context = context, tmplpath = "pillars/")
+                except Exception:
+                    print("Unable to parse the file {} with the provided variables: {}".format(test_data_yaml['file'], context))
+                    durations['render'] = time.perf_counter() - started
+                    main_return_value = 1
+                    records.append(target_error_record(f.name, target_label, plan.kind, durations, case_label))
+                    continue
+                durations['render'] = time.perf_counter() - started
+
+                started = time.perf_counter()
+                try:
+                    yaml_from_template = yaml_load(template_data.strip())
+                except Exception:
+                    if (plan.kind or "").startswith("content"):
+                      #print("Continuing with raw-non-yaml content")
+                      yaml_from_template = template_data.strip()
+                    else:
+                      print("Unable to load generated yaml content, is it real yaml ?")
+                      print("------------------")
+                      print(template_data.strip())
+                      print("------------------")
+                      print('Error was:')
+                      durations['load'] = time.perf_counter() - started
+                      main_return_value = 1
+                      records.append(target_error_record(f.name, target_label, plan.kind, durations, case_label))
+                      continue
+
+                #if verbose:
+                #  expected_result_yaml = yaml.dump(expected_results, Dumper = yaml.Dumper)
+                #  result_yaml          = yaml.dump(yaml_from_template, Dumper = yaml.Dumper)
+
+                durations['load'] = time.perf_counter() - started
+                if render_key is not None:
+                    render_cache[render_key] = (template_data, pickle.dumps(yaml_from_template))
+                    if len(render_cache) > render_cache_size:
+                        render_cache.popitem(last=False)
+
+            started = time.perf_counter()
+            return_value = 0
+            rendered_data = yaml_from_template
+            mismatches = []
+
+            if plan.kind == 'expected':
+                expected_results = test_data_yaml['expected']
+                if outputdir:
+                    output = write_output(outputdir, f.name, target_template_filename, case_label, template_data)
+
+                if expected_results != yaml_from_template:
+                    #print("BAD")
+                    return_value = 1
+
+            elif plan.kind == 'content':
+              expected_results = test_data_yaml['content'].strip()
+              current_result = template_data.strip()
+              if current_result != expected_results:
+                  return_value = 1
+
+            elif plan.kind == 'content_partial':
+              expected_results = test_data_yaml['content_partial'].strip()
+              current_result = template_data.strip()
+              #print('------------')
+              #print(current_result)
+              #print('------------')
+              #print(expected_results)
+              #print('------------')
+              if expected_results not in current_result:
+                  return_value = 1
+
+            elif plan.kind == 'expected_partial':
+                expected_results = test_data_yaml['expected_partial']
+                if outputdir:
+                    output = write_output(outputdir, f.name, target_template_filename, case_label, template_data)
+
+                if isinstance(yaml_from_template, dict) and isinstance(expected_results, dict):
+                    mismatches = match_partial(expected_results, yaml_from_template, tree_diff_max_differences)
+                    if mismatches or verbose:
+                        # The merged trees are the ones printed by the diff
+                        merged, yaml_from_template = merge_trees(yaml_from_template, expected_results)
+                        if mismatches:
+                            expected_results = merged
+                else:
+                    mismatches = [()]
+                if mismatches:
+                    return_value = 1
+
+            elif plan.kind == 'expected_absent':
+                expected_results = test_data_yaml['expected_absent']
+                if outputdir:
+                    output = write_output(outputdir, f.name, target_template_filename, case_label, template_data)
+                if isinstance(expected_results, dict):
+                    mismatches = match_absent(expected_results, yaml_from_template, tree_diff_max_differences)
+                    if mismatches:
+                        # The generated output without the keys which must be absent
+                        expected_results = without_paths(yaml_from_template, mismatches)
+                else:
+                    mismatches = [()]
+                if mismatches:
+                    return_value = 1
+
+            elif plan.kind == 'check_list':
+                for check in plan.checks:
+                    key_to_search = check.pattern
+                    items = [match.value  for match in check.find(rendered_data)]
+                    if len(items) == 0:
+                        print("No item found in this file")
+                        return_value = 1
+                        continue
+                    if not isinstance(items[0], list):
+                        expected_results = "{} to be a {}".format(key_to_search, "list")
+                        return_value = 1
+                        continue
+                    if check.condition == "morethan":
+                        value = check.value
+                        expected_results = "{} to be a list of {} {}".format(key_to_search, "morethan", value)
+                        if len(items[0]) < value:
+                            return_value = 1
+                    elif check.condition == "equalto":
+                        value = check.value
+                        expected_results = "{} to be a list of {} {}".format(key_to_search, "equalto", value)
+                        if len(items[0]) == value:
+                            return_value = 1
+                    elif check.condition == "lessthan":
+                        value = check.value
+                        expected_results = "{} to be a list of {} {}".format(key_to_search, "lessthan", value)
+                        if len(items[0]) > value:
+                            return_value = 1
+                    else:
+                        print("this token is not found")
+                        return_value = 1
+
+            elif plan.kind == 'check_string':
+                for check in plan.checks:
+                    key_to_search = check.pattern
+                    items = [match for match in check.find(rendered_data)]
+                    if not isinstance(items[0].value, str):
+                        expected_results = "{} to be a {}".format(key_to_search, "string")
+                        return_value = 1
+                        continue
+                    if check.condition == "notempty":
+                        value = check.value
+                        expected_results = "{} to be a {}".format(key_to_search, "not empty", value)
+                        if not value:
+                            return_value = 1
+                    elif check.condition == "stringnotempty":
+                        value = check.value
+                        expected_results = "{} to be a {}".format(key_to_search, "string")
+                        if value == "":
+                            return_value = 1
+                    #elif "stringiscontained"  in test_data_item[key_to_search]:
+                    #    value = test_data_item[key_to_search]["stringiscontained"]
+                    #    expected_results = "{} to be a string of {} {}".format(key_to_search, "stringiscontained", value)
+                    #    if value not in items[0].value:
+                    #        return_value = 1
+                    elif check.condition == "contains":
+                        value = check.value
+                        expected_results = "{} to be a string which contains {}".format(key_to_search, value)
+                        if value not in items[0].value:
+                            return_value = 1
+                    elif check.condition == "contains_key":
+                        value = str(items[0].context.path)
+                        expected_results = "{} to be a string ({}) containing {}".format(items[0].full_path, items[0].value, value)
+                        yaml_from_template = "{} to be a string ({})".format(items[0].full_path, items[0].value)
+                        #print(value, items[0].value, type(value), type(items[0].value), value in items[0].value)
+
+                        if value not in items[0].value:
+                            return_value = 1
+                    elif check.condition == "equalto":
+                        value = check.value
+                        expected_results = "{} to be a string of {} {}".format(key_to_search, "equalto", value)
+                        if value not in items[0].value:
+                            return_value = 1
+                    else:
+                        print("this token is not found")
+                        return_value = 1
+
+            elif plan.kind == 'check_int':
+                for check in plan.checks:
+                    key_to_search = check.pattern
+                    conditions = check.conditions
+                    items = [match for match in check.find(rendered_data)]
+                    yaml_from_template = "{} = {}".format(items[0].full_path, items[0].value)
+                    if not isinstance(items[0].value, int):
+                        expected_results = "{} to be a {}".format(key_to_search, "int")
+                        return_value = 1
+                        continue
+                    if check.condition == "equalto":
+                        value = check.value
+                        expected_results = "{} = {}".format(items[0].full_path, value)
+                        if value != items[0].value:
+                            return_value = 1
+                    elif check.condition == "greaterthan":
+                        value = check.value
+                        expected_results = "{} > {}".format(items[0].full_path, value)
+                        if value > items[0].value:
+                            return_value = 1
+                    elif check.condition == "lowerthan":
+                        value = check.value
+                        expected_results = "{} < {}".format(items[0].full_path, value)
+                        if value < items[0].value:
+                            return_value = 1
+                    else:
+                        print("this token '{}' is not found".format(conditions))
+                        return_value = 1
+            elif plan.kind == 'check_bool':
+                for check in plan.checks:
+                    key_to_search = check.pattern
+                    conditions = check.conditions
+                    items = [match for match in check.find(rendered_data)]
+                    yaml_from_template = "{} = {}".format(items[0].full_path, items[0].value)
+                    if not isinstance(items[0].value, bool):
+                        expected_results = "{} to be a {}".format(key_to_search, "bool")
+                        return_value = 1
+                        continue
+                    if check.condition == "is":
+                        value = check.value
+                        expected_results = "{} = {}".format(items[0].full_path, value)
+                        if value != items[0].value:
+                            return_value = 1
+                    else:
+                        print("this token '{}' is not found".format(conditions))
+                        return_value = 1
+            else:
+                print("No condition to test.")
+                return_value = 1
+                main_return_value = 1
+                durations['compare'] = time.perf_counter() - started
+                records.append(test_record(
+                    f.name, target_label, "failed", "No condition to test.", durations=durations, case=case_label
+                ))
+                continue
+            durations['compare'] = time.perf_counter() - started
+            started = time.perf_counter()
+
+            if verbose:
+                expected_result_yaml = yaml_dump(expected_results)
+                result_yaml          = yaml_dump(yaml_from_template)
+                print("### I was expecting:")
+                print(expected_result_yaml)
+                print("### But I got:")
+                print(result_yaml)
+
+            yml_diff = None
+            if return_value == 1:
+                main_return_value = 1
+                use_tree_diff = not plan.kind.startswith("content") and (
+                    diff_mode == "tree" or (
+                        diff_mode == "auto" and
+                        tree_size(expected_results, text_diff_max_nodes) + tree_size(yaml_from_template, text_diff_max_nodes) > text_diff_max_nodes
+                    )
+                )
+                if use_tree_diff:
+                    yml_diff = tree_diff(expected_results, yaml_from_template)
+                else:
+                    if plan.kind.startswith("content"):
+                        expected_result_yaml = expected_results
+                        result_yaml = current_result
+                    else:
+                        expected_result_yaml = yaml_dump(expected_results)
+                        result_yaml = yaml_dump(yaml_from_template)
+
+                    yml_diff = list(difflib.unified_diff(
+                        expected_result_yaml.splitlines(keepends=True),
+                        result_yaml.splitlines(keepends=True),
+                        fromfile="expected",
+                        tofile="generated",
+                    ))
+
+                if no_color:
+                    sys.stdout.writelines(yml_diff)
+                # sys.stdout.writelines(difflib.unified_diff(
+                #   expected_result_yaml.splitlines(keepends=True),
+                #   result_yaml.splitlines(keepends=True),
+                #   fromfile="expected",
+                #   tofile="generated",
+                # ))
+                else:
+                    for line in yml_diff:
+                        if line.startswith('+'):
+                            sys.stdout.write(colorama.Fore.GREEN + line + colorama.Fore.RESET)
+                        elif line.startswith('-'):
+                            sys.stdout.write(colorama.Fore.RED + line + colorama.Fore.RESET)
+                        elif line.startswith('^'):
+                            sys.stdout.write(colorama.Fore.BLUE + line + colorama.Fore.RESET)
+                        else:
+                            sys.stdout.write(line)
+
+            durations['diff'] = time.perf_counter() - started
+            if return_value == 1:
+                reason = "{} does not match".format(plan.kind)
+                if mismatches:
+                    reason = "{} at {}".format(reason, ", ".join(format_key_path(path) for path in mismatches))
+                if isinstance(expected_results, str) and plan.kind.startswith("check_"):
+                    reason = "{}: expecting {}".format(plan.kind, expected_results)
+                records.append(test_record(
+                    f.name, target_label, "failed", reason, plan.kind, yml_diff, durations, case_label, output
+                ))
+            else:
+                records.append(test_record(
+                    f.name, target_label, "passed", kind=plan.kind, durations=durations, case=case_label, output=output
+                ))
+
+    return(main_return_value)
+
+# Rendered and parsed outputs of the last rendered templates, by template
+# file and content, and variables of the test
+render_cache = collections.OrderedDict()
+render_cache_size = 256
+
+# Stack after the last rendered prefixes of a stack, pickled, by the hash of the
+# test variables and of the names and contents of the prefix files
+stack_cache = collections.OrderedDict()
+stack_cache_size = 1024
+
+def stack_config_files(stack):
+    if isinstance(stack, list):
+        return stack
+    return [stack]
+
+def stack_config_items(content):
+    # Same parsing as pillarstack: a yaml list, or a glob per line
+    try:
+        items = yaml_load(content)
+        if isinstance(items, list):
+            return items
+    except Exception:
+        pass
+    return content.splitlines()
+
+def render_stack_file(path, basedir, context, stack):
+    stack_context = dict(context)
+    stack_context.update({
+        'stack': stack,
+        'ymlpath': path,
+        '__stack__': {
+            'traverse': salt.utils.data.traverse_dict_and_list,
+            'cfg_path': basedir,
+        },
+    })
+    if CachedSandboxedEnvironment.coverage is not None:
+        CachedSandboxedEnvironment.coverage.current_filename = path
+    template_data = open(path, 'r', encoding="utf-8").read()
+    return salt.utils.templates.render_jinja_tmpl(
+        tmplstr = template_data, context = stack_context, tmplpath = os.path.join(basedir, "")
+    )
+
+def render_stack(config_files, context, variables_digest, until=None):
+    # Renders the stack files listed by the pillarstack config files in
+    # order, merging each one into the stack like pillarstack. The stack after
+    # each file is memoized, so tests sharing the variables and the first
+    # files of a stack only render the files after the longest known prefix.
+    stack = {}
+    until_matched = False
+    prefix_digest = hashlib.sha256(variables_digest)
+    for config_file in config_files:
+        basedir = os.path.dirname(config_file)
+        prefix_digest.update("\0{}\0{}".format(config_file, file_digest(config_file)).encode("utf-8"))
+        config_data = render_stack_file(config_file, basedir, context, stack)
+
+        for item in stack_config_items(config_data):
+            if not str(item).strip():
+                continue
+            for path in sorted(index_glob(os.path.join(basedir, str(item)))):
+                if until is not None:
+                    # Stops after the last file of the first run of files matching until
+                    if fnmatch.fnmatch(path, until):
+                        until_matched = True
+                    elif until_matched:
+                        return stack
+                prefix_digest.update("\0{}\0{}".format(path, file_digest(path)).encode("utf-8"))
+                key = prefix_digest.digest()
+                if key in stack_cache:
+                    stack = pickle.loads(stack_cache[key])
+                    stack_cache.move_to_end(key)
+                else:
+                    try:
+                        data = yaml_load(render_stack_file(path, basedir, context, stack))
+                    except Exception as e:
+                        raise Exception("Stack file {}: {}".format(path, e))
+                    if isinstance(data, dict):
+                        stack = salt.pillar.stack._merge_dict(stack, data)
+                    stack_cache[key] = pickle.dumps(stack)
+                    if len(stack_cache) > stack_cache_size:
+                        stack_cache.popitem(last=False)
+    if until is not None and not until_matched:
+        raise Exception("stack_until {} does not match a file of the stack".format(until))
+    return stack
+
+jsonpath_expressions = {}
+
+def parse_jsonpath(pattern):
+    # The jsonpath_rw parser is slow, every pattern is parsed only once
+    if pattern not in jsonpath_expressions:
+        jsonpath_expressions[pattern] = jsonpath_rw.parse(pattern)
+    return jsonpath_expressions[pattern]
+
+def get_item_from_pattern(pattern, data):
+    expression = parse_jsonpath(pattern)
+    return expression.find(data)
+
+# A template name is static when its string ends the tag or is followed by the
+# rest of an import or an include, any other expression is computed at render
+# time, as with {% include 'app/' ~ grains.os ~ '.yml' %}
+template_dependency_pattern = re.compile(
+    r"""\{%[-+]?\s*(?:include|import|from|extends|import_yaml|import_json|import_text)\s+"""
+    r"""(?:(['"])([^'"]*)\1\s*(?=[-+]?%\}|(?:import|as|ignore|with|without)\b)|\S)"""
+)
+template_dependency_cache = {}
+
+def template_direct_dependencies(filename):
+    if filename not in template_dependency_cache:
+        try:
+            template_data = open(filename, 'r', encoding="utf-8").read()
+        except Exception:
+            template_dependency_cache[filename] = set()
+            return template_dependency_cache[filename]
+        dependencies = set()
+        for match in template_dependency_pattern.finditer(template_data):
+            if match.group(2) is None:
+                # The template name is computed at render time
+                dependencies = None
+                break
+            # Same search path as the loader of render_jinja_tmpl()
+            dependencies.add(os.path.normpath(os.path.join("pillars", match.group(2))))
+        template_dependency_cache[filename] = dependencies
+    return template_dependency_cache[filename]
+
+def template_dependencies(filename):
+    # Every template included or imported by filename, recursively. None if
+    # one of them can not be known without rendering.
+    dependencies = set()
+    to_visit = [filename]
+    while to_visit:
+        direct_dependencies = template_direct_dependencies(to_visit.pop())
+        if direct_dependencies is None:
+            return None
+        for dependency in direct_dependencies - dependencies:
+            dependencies.add(dependency)
+            to_visit.append(dependency)
+    dependencies.discard(filename)
+    return dependencies
+
+def file_digest(filename):
+    try:
+        return hashlib.sha256(open(filename, 'rb').read()).hexdigest()
+    except OSError:
+        return "missing"
+
+def matched_targets(test_data_yaml):
+    # The targets of a test file, in the order they are run
+    if 'stack' in test_data_yaml:
+        return [", ".join(stack_config_files(test_data_yaml['stack']))]
+    target_template_filenames = set(index_glob(test_data_yaml['file']))
+    if "file_exclude" in test_data_yaml:
+        target_template_filenames -= set(index_glob(test_data_yaml["file_exclude"]))
+    return sorted(target_template_filenames)
+
+def test_input_files(testfile, test_data_yaml=None):
+    # The tested templates and their dependencies. None if they can not be
+    # known before rendering.
+    if test_data_yaml is None:
+        try:
+            test_data_yaml = load_yaml_cached(open(testfile, 'rb').read())
+        except Exception:
+            return None
+    if not isinstance(test_data_yaml, dict) or 'file' not in test_data_yaml:
+        return None
+
+    target_template_filenames = matched_targets(test_data_yaml)
+    if not target_template_filenames:
+        return None
+
+    files = set()
+    for target_template_filename in target_template_filenames:
+        dependencies = template_dependencies(target_template_filename)
+        if dependencies is None:
+            return None
+        files.add(os.path.normpath(target_template_filename))
+        files |= dependencies
+    return files
+
+def test_fingerprint(testfile):
+    # Hash of everything the result of a test depends on: the tester itself,
+    # the test file, the tested templates and their dependencies.
+    try:
+        test_data = open(testfile, 'rb').read()
+        test_data_yaml = load_yaml_cached(test_data)
+    except Exception:
+        return None
+    files = test_input_files(testfile, test_data_yaml)
+    if files is None:
+        return None
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(file_digest(os.path.realpath(__file__)).encode("utf-8"))
+    fingerprint.update(test_data)
+    for filename in sorted(files):
+        fingerprint.update("\0{}\0{}".format(filename, file_digest(filename)).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+def reverse_test_index(test_inputs):
+    # The tests using every template, and the tests whose templates can not
+    # be known before rendering
+    index = collections.defaultdict(set)
+    unknown_tests = set()
+    for testfile, inputs in test_inputs.items():
+        if inputs is None:
+            unknown_tests.add(testfile)
+            continue
+        for path in inputs:
+            index[path].add(testfile)
+    return index, unknown_tests
+
+def affected_test_files(test_files, test_inputs, changed):
+    index, affected_tests = reverse_test_index(test_inputs)
+    for path in changed:
+        affected_tests |= index.get(path, set())
+    return [
+        testfile for testfile in test_files
+        if testfile in affected_tests or os.path.normpath(testfile) in changed
+    ]
+
+def git_changed_files(ref):
+    # Files changed in the working tree since the common ancestor of ref and
+    # HEAD, including the untracked ones, relative to the current directory
+    base = subprocess.check_output(["git", "merge-base", ref, "HEAD"], universal_newlines=True).strip()
+    changed = subprocess.check_output(
+        ["git", "diff", "--name-only", "--relative", base], universal_newlines=True
+    ).splitlines()
+    changed += subprocess.check_output(
+        ["git", "ls-files", "--others", "--exclude-standard"], universal_newlines=True
+    ).splitlines()
+    return changed
+
+def changed_test_files(test_files, changed):
+    changed = set(os.path.normpath(path) for path in changed)
+    tester_files = [os.path.realpath(__file__), os.path.join(os.path.dirname(os.path.realpath(__file__)), 'template-tester.conf')]
+    if any(os.path.realpath(path) in tester_files for path in changed):
+        return test_files
+
+    test_inputs = dict((testfile, test_input_files(testfile)) for testfile in test_files)
+    affected_tests = set(affected_test_files(test_files, test_inputs, changed))
+    # A removed template is no longer matched by the glob of its tests
+    for path in changed:
+        if os.path.exists(path):
+            continue
+        for testfile in test_files:
+            try:
+                test_data_yaml = load_yaml_cached(open(testfile, 'rb').read())
+                if fnmatch.fnmatch(path, test_data_yaml['file']):
+                    affected_tests.add(testfile)
+            except Exception:
+                affected_tests.add(testfile)
+    return [testfile for testfile in test_files if testfile in affected_tests]
+
+def load_results_db(path):
+    try:
+        return json.load(open(path, 'r', encoding="utf-8"))
+    except Exception:
+        return {}
+
+def save_results_db(path, results_db):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    f = open(path + ".tmp", 'w', encoding="utf-8")
+    json.dump(results_db, f, indent=1, sort_keys=True)
+    f.close()
+    os.replace(path + ".tmp", path)
+
+def schedule_test_files(test_files, history, parallel):
+    # The tests which failed during their last run first, then the new tests,
+    # then the others. In parallel, the longest tests start first in each
+    # group so that no long test starts last.
+    def schedule_key(item):
+        position, testfile = item
+        if testfile not in history:
+            group = 1
+        elif history[testfile]['failed']:
+            group = 0
+        else:
+            group = 2
+        if parallel:
+            return (group, -history.get(testfile, {}).get('duration', 0), position)
+        return (group, position)
+    return [testfile for position, testfile in sorted(enumerate(test_files), key=schedule_key)]
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} is not of the form K/N".format(value))
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("{} is not a shard between 1/N and N/N".format(value))
+    return (index, count)
+
+def shard_test_files(test_files, history, index, count):
+    # Splits the tests in count shards of about the same duration: from the
+    # longest to the shortest, each test goes to the shard with the least
+    # total duration. The tests without a recorded duration are estimated
+    # from their file size. Every shard computes the same split as long as
+    # they see the same history.
+    sizes = dict((testfile, os.path.getsize(testfile) if os.path.isfile(testfile) else 0) for testfile in test_files)
+    timed = [testfile for testfile in sizes if testfile in history]
+    timed_size = sum(sizes[testfile] for testfile in timed)
+    seconds_per_byte = 0
+    if timed_size:
+        seconds_per_byte = sum(history[testfile]['duration'] for testfile in timed) / timed_size
+
+    def weight(testfile):
+        if testfile in history:
+            return history[testfile]['duration']
+        if seconds_per_byte:
+            return sizes[testfile] * seconds_per_byte
+        return sizes[testfile]
+
+    loads = [0] * count
+    shards = [set() for shard in range(count)]
+    for testfile in sorted(sizes, key=lambda testfile: (-weight(testfile), testfile)):
+        shard = min(range(count), key=lambda shard: (loads[shard], shard))
+        shards[shard].add(testfile)
+        loads[shard] += weight(testfile)
+    return [testfile for testfile in test_files if testfile in shards[index - 1]]
+
+def stats_add_test(stats, pillar, testfile):
+    if pillar not in stats:
+        stats[pillar] = {'count': 0, 'tests': []}
+
+    stats[pillar]['count'] += 1
+    stats[pillar]['tests'].append(testfile)
+
+    return stats
+
+
+def testable_pillar_files(config):
+    # The pillar templates expected to be tested, by --stats and --coverage
+    pillar_files = []
+    ignored_files = config['ignore']['files'].split("\n")
+    ignored_pattern = re.compile("|".join(re.escape(ignored) for ignored in ignored_files))
+    for pillar_file in index_glob('pillars/**/*.yml', recursive=True):
+        if ignored_pattern.search(pillar_file):
+            continue
+        if "pillars/customers/" in pillar_file:
+            continue
+        if pillar_file == "tests/template-tester.yml":
+            continue
+        if index_islink(pillar_file):
+            continue
+        if index_islink(os.path.dirname(pillar_file)):
+            continue
+        pillar_files.append(pillar_file)
+    return(pillar_files)
+
+def do_stats(test_files, config):
+    stats = {}
+    for pillar_file in testable_pillar_files(config):
+        stats[pillar_file] = {'count': 0, 'tests': []}
+
+    for test_file in test_files:
+        if test_file == "tests/template-tester.yml":
+            continue
+        test_data = open(test_file, 'rb').read()
+        test_data_yaml = load_yaml_cached(test_data)
+        tested_files = []
+        if 'file' in test_data_yaml:
+            tested_files = sorted(index_glob(test_data_yaml['file']))
+        for tested_file in tested_files:
+            stats = stats_add_test(stats, tested_file, test_file)
+
+    number_of_tested_file = 0
+    number_of_files = 0
+    number_of_tests = 0
+
+    for stat_pillar_file in sorted(stats):
+        number_of_test = "#" * stats[stat_pillar_file]['count'] or "-"
+        line = "{}: {} tests {}".format(stat_pillar_file, stats[stat_pillar_file]['count'], number_of_test)
+        if no_color is False:
+            if stats[stat_pillar_file]['count'] == 0:
+                color = colorama.Fore.RED
+            else:
+                color = colorama.Fore.GREEN
+            line = color + line + colorama.Fore.RESET
+        print(line)
+        if stats[stat_pillar_file]['count']:
+            number_of_tests += stats[stat_pillar_file]['count']
+            number_of_tested_file += 1
+        number_of_files += 1
+
+    percent_of_tested_files = (100 * number_of_tested_file) / number_of_files
+    print("number of files: {}, number of tested files: {} by {} tests".format(number_of_files, number_of_tested_file, number_of_tests))
+    print("Coverage: {}%".format(round(percent_of_tested_files, 2)))
+
+class JsonlReport():
+    def __init__(self, filename):
+        self.f = open(filename, 'w', encoding="utf-8")
+
+    def write(self, record):
+        self.f.write(json.dumps(record, default=str) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class JunitReport():
+    # Written as the tests run, the totals of the test suite are not known
+    # before the end, so they are left to the JUnit readers.
+    def __init__(self, filename):
+        self.f = open(filename, 'w', encoding="utf-8")
+        self.f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self.f.write('<testsuites>\n<testsuite name="template-tester" timestamp="{}">\n'.format(
+            datetime.datetime.now().isoformat()
+        ))
+        self.f.flush()
+
+    def write(self, record):
+        self.f.write('<testcase classname="{}" name="{}" time="{}">'.format(
+            html.escape(record['test']),
+            html.escape(record['target'] or record['test']),
+            record['duration'],
+        ))
+        if record['status'] != "passed":
+            element = "failure" if record['status'] == "failed" else "error"
+            self.f.write('<{0} message="{1}">{2}</{0}>'.format(
+                element,
+                html.escape(record['reason'] or ""),
+                html.escape("".join(record['diff'] or [])),
+            ))
+        self.f.write('</testcase>\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.write('</testsuite>\n</testsuites>\n')
+        self.f.close()
+
+def open_report(filename):
+    if filename.endswith(".xml"):
+        return JunitReport(filename)
+    return JsonlReport(filename)
+
+def init_worker(worker_no_color, worker_verbose, worker_diff_mode, cache_dir, coverage, profile, profile_dump, worker_file_index):
+    global no_color, verbose, diff_mode, file_index
+    no_color = worker_no_color
+    verbose = worker_verbose
+    diff_mode = worker_diff_mode
+    file_index = worker_file_index
+    enable_caches(cache_dir)
+    if coverage:
+        enable_coverage()
+    if profile:
+        tracemalloc.start()
+    if profile_dump:
+        enable_profiler()
+
+def pop_coverage_data():
+    if CachedSandboxedEnvironment.coverage is None:
+        return {}
+    return CachedSandboxedEnvironment.coverage.pop_data()
+
+profiler = None
+
+class ProfileStats():
+    # The stats of a cProfile.Profile, in the form accepted by pstats.Stats
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def enable_profiler():
+    global profiler
+    profiler = cProfile.Profile()
+
+def pop_profile_stats():
+    if profiler is None:
+        return {}
+    profiler.create_stats()
+    stats = profiler.stats
+    enable_profiler()
+    return stats
+
+def write_profile_stats(filename, profile_stats):
+    merged_stats = None
+    for stats in profile_stats:
+        if not stats:
+            continue
+        if merged_stats is None:
+            merged_stats = pstats.Stats(ProfileStats(stats))
+        else:
+            merged_stats.add(ProfileStats(stats))
+    if merged_stats is not None:
+        merged_stats.dump_stats(filename)
+
+def disable_profiler():
+    global profiler
+    stats = pop_profile_stats()
+    profiler = None
+    return stats
+
+def run_test_file(testfile, config, outputdir, records, targets=None):
+    if profiler is not None:
+        profiler.enable()
+    try:
+        return run_tests(
+            open(testfile, 'r', encoding="utf-8"),
+            config,
+            outputdir=outputdir,
+            records=records,
+            targets=targets
+        )
+    finally:
+        if profiler is not None:
+            profiler.disable()
+
+profile_phases = ['parse', 'glob', 'read', 'render', 'load', 'compare', 'diff']
+
+def format_bytes(size):
+    for unit in ['B', 'KiB', 'MiB']:
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} GiB".format(size)
+
+def print_profile_summary(records, top):
+    phase_totals = collections.OrderedDict((phase, 0.0) for phase in profile_phases)
+    for record in records:
+        for phase, duration in record['durations'].items():
+            phase_totals[phase] = phase_totals.get(phase, 0.0) + duration
+    total = sum(phase_totals.values())
+    print("Profile of {} tests, {:.3f}s:".format(len(records), total))
+    for phase, duration in phase_totals.items():
+        print("  {:<8} {:>9.3f}s {:>6.1f}%".format(
+            phase, duration, 100.0 * duration / total if total else 0.0
+        ))
+    print("Slowest tests:")
+    for record in sorted(records, key=lambda record: record['duration'], reverse=True)[:top]:
+        print("  {:>9.3f}s {:>10} {} against {}".format(
+            record['duration'],
+            format_bytes(record.get('peak_memory', 0)),
+            record['test'],
+            record['target'],
+        ))
+
+def run_tests_buffered(job):
+    # Runs in a pool worker: the whole output of a test file is captured so
+    # that diffs of concurrent tests never interleave on stdout.
+    testfile, config, outputdir = job
+    output = io.StringIO()
+    error = None
+    test_return_value = 1
+    records = []
+    with contextlib.redirect_stdout(output):
+        try:
+            test_return_value = run_test_file(testfile, config, outputdir, records)
+            # The pool may be terminated as soon as the results are received
+            flush_outputs()
+        except Exception:
+            error = traceback.format_exc()
+    return (
+        testfile, test_return_value, output.getvalue(), error, pop_coverage_data(), pop_profile_stats(), records
+    )
+
+budget_keys = ['timeout', 'max_memory']
+budget_poll_interval = 0.05
+
+def test_budgets(test_files, config):
+    # The time (seconds) and memory (MB) budgets of the test files which have
+    # one: their timeout and max_memory keys, or the ones of template-tester.conf
+    defaults = dict((key, config['DEFAULT'].getfloat(key, 0)) for key in budget_keys)
+    budgets = {}
+    for testfile in test_files:
+        budget = dict(defaults)
+        try:
+            test_data_yaml = load_yaml_cached(open(testfile, 'rb').read())
+        except Exception:
+            test_data_yaml = None
+        if isinstance(test_data_yaml, dict):
+            for key in budget_keys:
+                if key not in test_data_yaml:
+                    continue
+                try:
+                    budget[key] = float(test_data_yaml[key] or 0)
+                except (TypeError, ValueError):
+                    print("Error: {} of {} is not a number, using {}.".format(key, testfile, budget[key]))
+        if budget['timeout'] or budget['max_memory']:
+            budgets[testfile] = (budget['timeout'], budget['max_memory'])
+    return budgets
+
+def process_rss(pid):
+    # Resident memory of a process in bytes, None where /proc is missing
+    try:
+        with open("/proc/{}/statm".format(pid), 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def budget_worker(connection, initargs):
+    init_worker(*initargs)
+    while True:
+        job = connection.recv()
+        if job is None:
+            break
+        connection.send(run_tests_buffered(job))
+
+class BudgetWorker():
+    # A worker process running one test file at a time, killed when the test
+    # exceeds its budget
+    def __init__(self, initargs):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=budget_worker, args=(worker_connection, initargs), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        self.index = None
+
+    def start(self, index, job, budget):
+        self.index = index
+        self.testfile = job[0]
+        self.timeout, self.max_memory = budget
+        self.started = time.monotonic()
+        self.base_rss = process_rss(self.process.pid)
+        self.connection.send(job)
+
+    def exceeded_budget(self):
+        if self.timeout and time.monotonic() - self.started > self.timeout:
+            return "Timeout: running for more than {:g} s".format(self.timeout)
+        if self.max_memory and self.base_rss is not None:
+            rss = process_rss(self.process.pid)
+            if rss is not None and rss - self.base_rss > self.max_memory * 1024 * 1024:
+                return "Out of memory: more than {:g} MB allocated".format(self.max_memory)
+        return None
+
+    def killed_result(self, reason):
+        message = "Error: {}: {}, the worker running it was killed.\n".format(self.testfile, reason)
+        record = test_record(self.testfile, None, "error", reason, durations={'render': time.monotonic() - self.started})
+        return (self.testfile, 1, message, None, {}, {}, [record])
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+def iter_budget_results(test_files, config, outputdir, jobs, initargs, budgets):
+    # Like pool.imap(), with a worker per job replaced when its test exceeds
+    # its time or memory budget or when it dies
+    workers = [BudgetWorker(initargs) for job in range(max(jobs, 1))]
+    waiting = collections.deque(enumerate(test_files))
+    results = {}
+    next_index = 0
+    try:
+        while next_index < len(test_files):
+            for worker in workers:
+                if worker.index is None and waiting:
+                    index, testfile = waiting.popleft()
+                    worker.start(index, (testfile, config, outputdir), budgets.get(testfile, (0, 0)))
+            busy_workers = [worker for worker in workers if worker.index is not None]
+            ready = multiprocessing.connection.wait(
+                [worker.connection for worker in busy_workers], timeout=budget_poll_interval
+            )
+            for worker in busy_workers:
+                result = None
+                reason = None
+                if worker.connection in ready:
+                    try:
+                        result = worker.connection.recv()
+                    except (EOFError, OSError):
+                        reason = "The worker died while running the test"
+                else:
+                    reason = worker.exceeded_budget()
+                if reason is not None:
+                    result = worker.killed_result(reason)
+                    worker.stop()
+                    workers[workers.index(worker)] = BudgetWorker(initargs)
+                if result is not None:
+                    results[worker.index] = result
+                    worker.index = None
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+    finally:
+        for worker in workers:
+            worker.stop()
+
+def iter_test_results(
+    test_files, config, outputdir="", jobs=1, cache_dir="", coverage_data=None, profile_stats=None, budgets=None
+):
+    if jobs <= 1 and not budgets:
+        for testfile in test_files:
+            records = []
+            test_return_value = run_test_file(testfile, config, outputdir, records)
+            yield (testfile, test_return_value, records)
+        return
+
+    initargs = (
+        no_color, verbose, diff_mode, cache_dir, coverage_data is not None, tracemalloc.is_tracing(), profile_stats is not None,
+        file_index
+    )
+    pool = None
+    if budgets:
+        results = iter_budget_results(test_files, config, outputdir, jobs, initargs, budgets)
+    else:
+        pool = multiprocessing.Pool(
+            processes=jobs,
+            initializer=init_worker,
+            initargs=initargs
+        )
+        # imap keeps the submission order, so the output and the --stop
+        # behaviour are the same as a serial run.
+        results = pool.imap(
+            run_tests_buffered,
+            [(testfile, config, outputdir) for testfile in test_files]
+        )
+    try:
+        for testfile, test_return_value, output, error, worker_coverage_data, worker_profile_stats, records in results:
+            if coverage_data is not None:
+                merge_coverage(coverage_data, worker_coverage_data)
+            if profile_stats is not None:
+                profile_stats.append(worker_profile_stats)
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if error is not None:
+                sys.stderr.write(error)
+                sys.exit(1)
+            yield (testfile, test_return_value, records)
+    finally:
+        if pool is None:
+            results.close()
+        else:
+            pool.terminate()
+            pool.join()
+
+def collect_test_files(paths, default_test_dir):
+    test_files = []
+    if type(paths) == list and paths:
+      for args_file in paths:
+        if os.path.isdir(args_file):
+          print(
+            'is dir',
+            "{}/{}".format(
+              args_file.rstrip('/'),
+              "*.yml"
+            )
+          )
+          test_files += sorted(index_glob(
+              "{}/**/{}".format(args_file.rstrip('/'), '*.yml'),
+              recursive=True
+          ))
+        else:
+          test_files += [args_file]
+    else:
+        test_files = sorted(index_glob(
+            '{}/**/*.yml'.format(default_test_dir.rstrip('/')),
+            recursive=True
+        ))
+    return test_files
+
+def run_test_files(test_files, config, args, cache_dir):
+    return_value = 0
+    # The templates included by the rendered templates may have changed since
+    # the previous run of a server or watch
+    render_cache.clear()
+    stack_cache.clear()
+    test_files = [testfile for testfile in test_files if testfile != "tests/template-tester.yml"]
+
+    cached_tests = []
+    fingerprints = {}
+    if args.incremental:
+        if not cache_dir:
+            print("Error: --incremental requires a cache directory.")
+            return(1)
+        results_db_path = os.path.join(cache_dir, "results.json")
+        results_db = load_results_db(results_db_path)
+        for testfile in test_files:
+            fingerprints[testfile] = test_fingerprint(testfile)
+            if args.force or fingerprints[testfile] is None:
+                continue
+            if results_db.get(testfile) == fingerprints[testfile]:
+                cached_tests.append(testfile)
+        for testfile in cached_tests:
+            print("{} unchanged {} ...".format(" "*28, testfile))
+        test_files = [testfile for testfile in test_files if testfile not in set(cached_tests)]
 
-    if not test_data_yaml:
-        print("Error: Test file {} is empty.".format(f.name))
-        return(1)
+    history = {}
+    if cache_dir:
+        history_path = os.path.join(cache_dir, "history.json")
+        history = load_results_db(history_path)
+        if args.order == "history":
+            test_files = schedule_test_files(test_files, history, args.jobs > 1)
 
-    target_template_filenames = sorted(glob.glob(test_data_yaml['file']))
+    coverage_data = None
+    if args.coverage:
+        enable_coverage()
+        coverage_data = {}
 
-    if len(target_template_filenames) == 0:
-        print("{} does not match a file".format(test_data_yaml['file']))
-        return(1)
+    profile_stats = None
+    if args.profile:
+        tracemalloc.start()
+    if args.profile_dump:
+        enable_profiler()
+        profile_stats = []
 
-    excluded_files = []
-    if "file_exclude" in test_data_yaml:
-        excluded_files = sorted(glob.glob(test_data_yaml["file_exclude"]))
-        for excluded_file in excluded_files:
-            print("{} skipping {} ...".format(" "*28, excluded_file))
+    reports = [open_report(filename) for filename in args.report]
 
-        target_template_filenames = set(target_template_filenames) - set(excluded_files)
+    failed_tests = []
+    profiled_records = []
+    ran_tests = set()
+    output_records = []
+    test_results = iter_test_results(
+        test_files,
+        config,
+        outputdir=args.write_dir,
+        jobs=args.jobs,
+        cache_dir=cache_dir,
+        coverage_data=coverage_data,
+        profile_stats=profile_stats,
+        budgets=test_budgets(test_files, config)
+    )
+    # The reports stay valid documents when the run is interrupted
+    try:
+        for testfile, test_return_value, records in test_results:
+            for report in reports:
+                for record in records:
+                    report.write(record)
+            if args.profile:
+                profiled_records += records
+            if args.write_dir:
+                ran_tests.add(testfile)
+                output_records += records
+            history[testfile] = {
+                'duration': round(sum(record['duration'] for record in records), 6),
+                'failed': test_return_value == 1,
+            }
+            return_value |= test_return_value
+            if args.incremental:
+                if test_return_value == 0 and fingerprints[testfile] is not None:
+                    results_db[testfile] = fingerprints[testfile]
+                else:
+                    results_db.pop(testfile, None)
+            if test_return_value == 1:
+                failed_tests.append(testfile)
+                if args.stop:
+                  break
+    finally:
+        test_results.close()
+        for report in reports:
+            report.close()
+        if args.coverage:
+            merge_coverage(coverage_data, pop_coverage_data())
+            seed_coverage(coverage_data, config)
+            # A server runs the next requests without the counters
+            disable_coverage()
 
-    main_return_value = 0
+    if args.write_dir:
+        close_outputs()
+        write_output_manifest(args.write_dir, ran_tests, output_records)
 
-    for target_template_filename in target_template_filenames:
-        if target_template_filename != test_data_yaml['file']:
-            print("{} against {} ...".format(" "*28, target_template_filename))
-        if 'file' in test_data_yaml:
-            try:
-                target_template_file = open(target_template_filename, 'r', encoding="utf-8")
-                target_template_data = target_template_file.read()
-            except Exception as e:
-                print("Error: File '{}' not found for test file {}".format(test_data_yaml['file'], f.name))
-                print(e)
-                return(1)
-        elif 'wrapper' in test_data_yaml:
-            print(test_data_yaml)
-            target_template_data = test_data_yaml['wrapper']
-            print(target_template_data)
-
-        saltobject = SaltObject()
-        context = {
-            'opts': {
-              'jinja_env': {},
-              'jinja_sls_env': {},
-            },
-            'sls': {},
-            'saltenv': {},
-            'salt': saltobject,
-            '__salt__': saltobject,
-        }
-        if '__call' in test_data_yaml['variables']:
-            for modulename, funcname in test_data_yaml['variables']['__call'].items():
-                saltobject.add_call(modulename, funcname)
-            context['__opts__'] = context['opts']
-            globals()['__opts__'] = context['opts']
-        if 'salt' in test_data_yaml['variables']:
-            saltobject.inject(test_data_yaml['variables'].pop('salt'))
-            # print("injected")
-        context.update(test_data_yaml['variables'])
-        if verbose:
-            print("### Given:")
-            print(yaml.dump(context, Dumper = yaml.Dumper))
-        #print(target_template_data)
-        # print("final context", context, "opts", __opts__)
+    # The shards of a run must split the tests with the same history, it is
+    # recorded by merge once every shard ran
+    if cache_dir and not args.shard:
+        save_results_db(history_path, history)
 
-        try:
-            template_data = salt.utils.templates.render_jinja_tmpl(tmplstr = target_template_data, context = context, tmplpath = "pillars/")
-        except Exception as e:
-            print("Unable to parse the file {} with the provided variables: {}".format(test_data_yaml['file'], context))
-            raise e
-            return(1)
+    if args.incremental:
+        save_results_db(results_db_path, results_db)
+        print("{} tests run, {} tests unchanged since their last successful run.".format(
+            len(test_files), len(cached_tests)
+        ))
 
-        try:
-            yaml_from_template = yaml.load(template_data.strip(), Loader = yaml.SafeLoader)
-        except Exception as e:
-            if 'content' in test_data_yaml:
-              #print("Continuing with raw-non-yaml content")
-              yaml_from_template = template_data.strip()
-            else:
-              print("Unable to load generated yaml content, is it real yaml ?")
-              print("------------------")
-              print(template_data.strip())
-              print("------------------")
-              print('Error was:')
-              raise e
-
-        #if verbose:
-        #  expected_result_yaml = yaml.dump(expected_results, Dumper = yaml.Dumper)
-        #  result_yaml          = yaml.dump(yaml_from_template, Dumper = yaml.Dumper)
-
-        return_value = 0
-
-        if 'expected' in test_data_yaml:
-            expected_results = test_data_yaml['expected']
-            if outputdir:
-                write_output(outputdir, f.name, template_data)
-
-            if expected_results != yaml_from_template:
-                #print("BAD")
-                return_value = 1
+    if args.coverage:
+        write_coverage_report(args.coverage, coverage_data)
+        print_coverage_summary(coverage_data)
 
-        elif 'content' in test_data_yaml:
-          expected_results = test_data_yaml['content'].strip()
-          current_result = template_data.strip()
-          if current_result != expected_results:
-              return_value = 1
-
-        elif 'content_partial' in test_data_yaml:
-          expected_results = test_data_yaml['content_partial'].strip()
-          current_result = template_data.strip()
-          #print('------------')
-          #print(current_result)
-          #print('------------')
-          #print(expected_results)
-          #print('------------')
-          if expected_results not in current_result:
-              return_value = 1
-
-        elif 'expected_partial' in test_data_yaml:
-            expected_results = copy.deepcopy(test_data_yaml['expected_partial'])
-            if outputdir:
-                write_output(outputdir, f.name, template_data)
-
-            original = yaml_from_template.copy()
-            merged = dict(mergedicts(original, expected_results))
-            if merged != yaml_from_template:
-                expected_results = merged
-                return_value = 1
+    if args.profile:
+        tracemalloc.stop()
+        print_profile_summary(profiled_records, args.profile_top)
 
-        elif 'expected_absent' in test_data_yaml:
-            expected_results = test_data_yaml['expected_absent']
-            if outputdir:
-                write_output(outputdir, f.name, template_data)
-            original = yaml_from_template.copy()
-            merged = dict(mergedicts(expected_results, original))
-            r = check_dict_not_in_dict(expected_results, original)
+    if args.profile_dump:
+        profile_stats.append(disable_profiler())
+        write_profile_stats(args.profile_dump, profile_stats)
+        print("cProfile statistics written to {}".format(args.profile_dump))
 
-            if not r:
-                expected_results = merged
-                return_value = 1
+    if return_value == 0:
+        print("All checks are ok.")
+    else:
+        print("The following tests failed:")
+        for failed_test in failed_tests:
+            print("* {}".format(failed_test))
+    return(return_value)
 
-        elif 'check_list' in test_data_yaml:
-            test_data_item = test_data_yaml["check_list"]
-            for key_to_search, conditions in test_data_item.items():
-                items = [match.value  for match in get_item_from_pattern(key_to_search, yaml_from_template.copy())]
-                if len(items) == 0:
-                    print("No item found in this file")
-                    return_value = 1
-                    continue
-                if not isinstance(items[0], list):
-                    expected_results = "{} to be a {}".format(key_to_search, "list")
-                    return_value = 1
+def snapshot_files(directories):
+    snapshot = {}
+    for directory in directories:
+        for root, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.normpath(os.path.join(root, filename))
+                try:
+                    st = os.stat(path)
+                except OSError:
                     continue
-                if "morethan" in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["morethan"]
-                    expected_results = "{} to be a list of {} {}".format(key_to_search, "morethan", value)
-                    if len(items[0]) < value:
-                        return_value = 1
-                elif "equalto" in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["equalto"]
-                    expected_results = "{} to be a list of {} {}".format(key_to_search, "equalto", value)
-                    if len(items[0]) == value:
-                        return_value = 1
-                elif "lessthan" in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["lessthan"]
-                    expected_results = "{} to be a list of {} {}".format(key_to_search, "lessthan", value)
-                    if len(items[0]) > value:
-                        return_value = 1
-                else:
-                    print("this token is not found")
-                    return_value = 1
+                snapshot[path] = (st.st_mtime_ns, st.st_size)
+    return snapshot
 
-        elif 'check_string' in test_data_yaml:
-            test_data_item = test_data_yaml["check_string"]
-            for key_to_search, conditions in test_data_item.items():
-                items = [match for match in get_item_from_pattern(key_to_search, yaml_from_template.copy())]
-                if not isinstance(items[0].value, str):
-                    expected_results = "{} to be a {}".format(key_to_search, "string")
-                    return_value = 1
-                    continue
-                if "notempty"  in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["notempty"]
-                    expected_results = "{} to be a {}".format(key_to_search, "not empty", value)
-                    if not value:
-                        return_value = 1
-                elif "stringnotempty"  in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["stringnotempty"]
-                    expected_results = "{} to be a {}".format(key_to_search, "string")
-                    if value == "":
-                        return_value = 1
-                #elif "stringiscontained"  in test_data_item[key_to_search]:
-                #    value = test_data_item[key_to_search]["stringiscontained"]
-                #    expected_results = "{} to be a string of {} {}".format(key_to_search, "stringiscontained", value)
-                #    if value not in items[0].value:
-                #        return_value = 1
-                elif "contains" in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["contains"]
-                    expected_results = "{} to be a string which contains {}".format(key_to_search, value)
-                    if value not in items[0].value:
-                        return_value = 1
-                elif "contains_key" in test_data_item[key_to_search]:
-                    value = str(items[0].context.path)
-                    expected_results = "{} to be a string ({}) containing {}".format(items[0].full_path, items[0].value, value)
-                    yaml_from_template = "{} to be a string ({})".format(items[0].full_path, items[0].value)
-                    #print(value, items[0].value, type(value), type(items[0].value), value in items[0].value)
+def iter_polled_changes(directories, interval=1.0):
+    previous = snapshot_files(directories)
+    while True:
+        time.sleep(interval)
+        current = snapshot_files(directories)
+        changed = set(
+            path for path in set(previous) | set(current)
+            if previous.get(path) != current.get(path)
+        )
+        previous = current
+        if changed:
+            yield changed
 
-                    if value not in items[0].value:
-                        return_value = 1
-                elif "equalto"  in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["equalto"]
-                    expected_results = "{} to be a string of {} {}".format(key_to_search, "equalto", value)
-                    if value not in items[0].value:
-                        return_value = 1
-                else:
-                    print("this token is not found")
-                    return_value = 1
+def iter_inotify_changes(directories):
+    inotify = inotify_simple.INotify()
+    flags = inotify_simple.flags
+    mask = flags.CLOSE_WRITE | flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO
+    watches = {}
 
-        elif 'check_int' in test_data_yaml:
-            test_data_item = test_data_yaml["check_int"]
-            for key_to_search, conditions in test_data_item.items():
-                items = [match for match in get_item_from_pattern(key_to_search, yaml_from_template.copy())]
-                yaml_from_template = "{} = {}".format(items[0].full_path, items[0].value)
-                if not isinstance(items[0].value, int):
-                    expected_results = "{} to be a {}".format(key_to_search, "int")
-                    return_value = 1
-                    continue
-                if "equalto"  in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["equalto"]
-                    expected_results = "{} = {}".format(items[0].full_path, value)
-                    if value != items[0].value:
-                        return_value = 1
-                elif "greaterthan"  in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["greaterthan"]
-                    expected_results = "{} > {}".format(items[0].full_path, value)
-                    if value > items[0].value:
-                        return_value = 1
-                elif "lowerthan"  in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["lowerthan"]
-                    expected_results = "{} < {}".format(items[0].full_path, value)
-                    if value < items[0].value:
-                        return_value = 1
-                else:
-                    print("this token '{}' is not found".format(conditions))
-                    return_value = 1
-        elif 'check_bool' in test_data_yaml:
-            test_data_item = test_data_yaml["check_bool"]
-            for key_to_search, conditions in test_data_item.items():
-                items = [match for match in get_item_from_pattern(key_to_search, yaml_from_template.copy())]
-                yaml_from_template = "{} = {}".format(items[0].full_path, items[0].value)
-                if not isinstance(items[0].value, bool):
-                    expected_results = "{} to be a {}".format(key_to_search, "bool")
-                    return_value = 1
-                    continue
-                if "is"  in test_data_item[key_to_search]:
-                    value = test_data_item[key_to_search]["is"]
-                    expected_results = "{} = {}".format(items[0].full_path, value)
-                    if value != items[0].value:
-                        return_value = 1
-                else:
-                    print("this token '{}' is not found".format(conditions))
-                    return_value = 1
-        else:
-            print("No condition to test.")
-            return_value = 1
-            main_return_value = 1
-            continue
+    def add_watches(directory):
+        for root, dirnames, filenames in os.walk(directory):
+            watches[inotify.add_watch(root, mask)] = root
 
-        if verbose:
-            expected_result_yaml = yaml.dump(expected_results, Dumper=yaml.SafeDumper)
-            result_yaml          = yaml.dump(yaml_from_template, Dumper=yaml.SafeDumper)
-            print("### I was expecting:")
-            print(expected_result_yaml)
-            print("### But I got:")
-            print(result_yaml)
+    for directory in directories:
+        add_watches(directory)
 
+    while True:
+        events = inotify.read()
+        # Editors write a file in several steps, group them
+        events += inotify.read(timeout=100)
+        changed = set()
+        for event in events:
+            if event.wd not in watches or not event.name:
+                continue
+            path = os.path.normpath(os.path.join(watches[event.wd], event.name))
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    add_watches(path)
+                continue
+            changed.add(path)
+        if changed:
+            yield changed
 
-        if return_value == 1:
-            main_return_value = 1
-            if 'content' in test_data_yaml:
-                expected_result_yaml = expected_results
-                result_yaml = current_result
-            else:
-                expected_result_yaml = yaml.dump(expected_results, Dumper=yaml.SafeDumper)
-                result_yaml = yaml.dump(yaml_from_template, Dumper=yaml.SafeDumper)
-
-            yml_diff = difflib.unified_diff(
-                expected_result_yaml.splitlines(keepends=True),
-                result_yaml.splitlines(keepends=True),
-                fromfile="expected",
-                tofile="generated",
-            )
+def iter_file_changes(directories):
+    directories = sorted(set(
+        os.path.normpath(directory) for directory in directories if os.path.isdir(directory)
+    ))
+    if inotify_simple is not None:
+        return iter_inotify_changes(directories)
+    return iter_polled_changes(directories)
 
-            if no_color:
-                sys.stdout.writelines(yml_diff)
-            # sys.stdout.writelines(difflib.unified_diff(
-            #   expected_result_yaml.splitlines(keepends=True),
-            #   result_yaml.splitlines(keepends=True),
-            #   fromfile="expected",
-            #   tofile="generated",
-            # ))
-            else:
-                for line in yml_diff:
-                    if line.startswith('+'):
-                        sys.stdout.write(colorama.Fore.GREEN + line + colorama.Fore.RESET)
-                    elif line.startswith('-'):
-                        sys.stdout.write(colorama.Fore.RED + line + colorama.Fore.RESET)
-                    elif line.startswith('^'):
-                        sys.stdout.write(colorama.Fore.BLUE + line + colorama.Fore.RESET)
-                    else:
-                        sys.stdout.write(line)
+def watch_tests(paths, default_test_dir, config, args, cache_dir):
+    if paths:
+        watched_dirs = [path if os.path.isdir(path) else os.path.dirname(path) or "." for path in paths]
+    else:
+        watched_dirs = [default_test_dir]
+    watched_dirs.append("pillars")
 
-    return(main_return_value)
+    test_files = collect_test_files(paths, default_test_dir)
+    test_inputs = dict((testfile, test_input_files(testfile)) for testfile in test_files)
+    return_value = run_test_files(test_files, config, args, cache_dir)
 
-def get_item_from_pattern(pattern, data):
-    expression = jsonpath_rw.parse(pattern)
-    return expression.find(data)
+    try:
+        for changed in iter_file_changes(watched_dirs):
+            for path in changed:
+                template_dependency_cache.pop(path, None)
+            index_files(["pillars", default_test_dir], cache_dir)
 
-def stats_add_test(stats, pillar, testfile):
-    if pillar not in stats:
-        stats[pillar] = {'count': 0, 'tests': []}
+            known_files = set(os.path.normpath(testfile) for testfile in test_files)
+            for inputs in test_inputs.values():
+                known_files |= inputs or set()
+            if any(path not in known_files or not os.path.exists(path) for path in changed):
+                # A file appeared or disappeared, globs may match other files
+                test_files = collect_test_files(paths, default_test_dir)
+                test_inputs = dict((testfile, test_input_files(testfile)) for testfile in test_files)
+            else:
+                for testfile in test_files:
+                    if os.path.normpath(testfile) in changed:
+                        test_inputs[testfile] = test_input_files(testfile)
 
-    stats[pillar]['count'] += 1
-    stats[pillar]['tests'].append(testfile)
+            affected_tests = affected_test_files(test_files, test_inputs, changed)
+            print("[{}] {} files changed, running {} tests ...".format(
+                datetime.datetime.now().isoformat(), len(changed), len(affected_tests)
+            ))
+            if affected_tests:
+                return_value = run_test_files(affected_tests, config, args, cache_dir)
+    except KeyboardInterrupt:
+        pass
+    return(return_value)
 
-    return stats
+def read_config():
+    config_path = os.path.dirname(os.path.realpath(__file__))
+    config = configparser.ConfigParser()
+    config.read("{}/{}".format(config_path, 'template-tester.conf'))
+    return config
 
+def default_cache_dir():
+    # A directory per project outside of the checkout: the caches are loaded
+    # with pickle, they must not come from the tested branch
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    project = hashlib.sha256(os.path.realpath(os.getcwd()).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_home, "template-tester", project)
 
-def do_stats(test_files, config):
-    stats = {}
-    ignored_files = config['ignore']['files'].split("\n")
-    for pillar_file in glob.glob('pillars/**/*.yml', recursive=True):
-        must_be_ignored = False
-        for ignored in ignored_files:
-            if ignored in pillar_file:
-                #print("Skipping ignored {} because {}".format(pillar_file, ignored))
-                must_be_ignored = True
-                break
-        if must_be_ignored:
-            continue
-        if "pillars/customers/" in pillar_file:
-            continue
-        if pillar_file == "tests/template-tester.yml":
-            continue
-        if os.path.islink(pillar_file):
-            continue
-        if os.path.islink(os.path.dirname(pillar_file)):
-            continue
-        stats[pillar_file] = {'count': 0, 'tests': []}
+def configured_cache_dir(config, cache_dir=None):
+    if cache_dir is not None:
+        return cache_dir
+    if 'DEFAULT' in config and 'cache_dir' in config['DEFAULT']:
+        return config['DEFAULT']['cache_dir']
+    return default_cache_dir()
 
-    for test_file in test_files:
-        if test_file == "tests/template-tester.yml":
-            continue
-        test_data = open(test_file).read()
-        test_data_yaml = yaml.load(test_data, Loader=yaml.SafeLoader)
-        tested_files = sorted(glob.glob(test_data_yaml['file']))
-        for tested_file in tested_files:
-            stats = stats_add_test(stats, tested_file, test_file)
+def configured_test_dir(config):
+    if 'DEFAULT' in config and 'test_dir' in config['DEFAULT']:
+        return config['DEFAULT']['test_dir']
+    return "tests"
 
-    number_of_tested_file = 0
-    number_of_files = 0
-    number_of_tests = 0
+# Library API, used by template_tester.py and the pytest plugin. The functions
+# below return the results of the tests instead of printing them, they run
+# from the directory holding pillars/ and the tests like the command line.
 
-    for stat_pillar_file in sorted(stats):
-        number_of_test = "#" * stats[stat_pillar_file]['count'] or "-"
-        line = "{}: {} tests {}".format(stat_pillar_file, stats[stat_pillar_file]['count'], number_of_test)
-        if no_color is False:
-            if stats[stat_pillar_file]['count'] == 0:
-                color = colorama.Fore.RED
-            else:
-                color = colorama.Fore.GREEN
-            line = color + line + colorama.Fore.RESET
-        print(line)
-        if stats[stat_pillar_file]['count']:
-            number_of_tests += stats[stat_pillar_file]['count']
-            number_of_tested_file += 1
-        number_of_files += 1
+def configure(cache_dir=None, diff="auto", verbose_output=False):
+    # Sets up the tester like main() does from its options, returns the
+    # configuration passed to the other functions
+    global no_color, verbose, diff_mode
+    no_color = True
+    verbose = verbose_output
+    diff_mode = diff
+    config = read_config()
+    cache_dir = configured_cache_dir(config, cache_dir)
+    enable_caches(cache_dir)
+    index_files(["pillars", configured_test_dir(config)], cache_dir)
+    return config
 
-    percent_of_tested_files = (100 * number_of_tested_file) / number_of_files
-    print("number of files: {}, number of tested files: {} by {} tests".format(number_of_files, number_of_tested_file, number_of_tests))
-    print("Coverage: {}%".format(round(percent_of_tested_files, 2)))
+def collect_tests(config, paths=None):
+    # The test files, under the configured test directory by default
+    test_files = collect_test_files(paths or [], configured_test_dir(config))
+    return [testfile for testfile in test_files if testfile != "tests/template-tester.yml"]
 
+def test_file_targets(testfile):
+    # The targets of a test file, empty if it does not match any
+    test_data_yaml = load_yaml_cached(open(testfile, 'rb').read())
+    if not isinstance(test_data_yaml, dict) or ('file' not in test_data_yaml and 'stack' not in test_data_yaml):
+        return []
+    return matched_targets(test_data_yaml)
+
+def run_test(config, testfile, targets=None):
+    # Runs a test file, or only some of its targets. Returns the records of
+    # its targets (see test_record()) and the text it would have printed.
+    records = []
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        run_test_file(testfile, config, "", records, targets)
+    return records, output.getvalue()
+
+def main(argv, allow_watch=True):
+    global no_color, verbose, diff_mode
 
-if __name__ == "__main__":
     #a = {'foo': 'foo', 'bar': 'bar'}
     #print(check_dict_not_in_dict({'baz': None}, a))
     #sys.exit(0)
@@ -553,76 +2845,330 @@ if __name__ == "__main__":
       default=False,
       action="store_true",
     )
+    parser.add_argument(
+      '-j', '--jobs',
+      help="Number of test files to run in parallel",
+      default=1,
+      type=int
+    )
     parser.add_argument(
       '-w', '--write-dir',
       help="Write generated files in directory",
       default="",
       type=str
     )
-    args = parser.parse_args()
+    parser.add_argument(
+      '-C', '--cache-dir',
+      help="Directory of the persistent caches, empty to disable them",
+      default=None,
+      type=str
+    )
+    parser.add_argument(
+      '-i', '--incremental',
+      help="Skip the tests unchanged since their last successful run",
+      default=False,
+      action="store_true"
+    )
+    parser.add_argument(
+      '-F', '--force',
+      help="With --incremental, run every test and refresh the results",
+      default=False,
+      action="store_true"
+    )
+    parser.add_argument(
+      '-W', '--watch',
+      help="Keep running and re-run the tests affected by each file change",
+      default=False,
+      action="store_true"
+    )
+    parser.add_argument(
+      '-c', '--coverage',
+      help="Measure the line and branch coverage of the templates, and write the reports in this directory",
+      default="",
+      type=str
+    )
+    parser.add_argument(
+      '-r', '--report',
+      help="Write a result per test and target file in this file, as JUnit XML if its name ends with .xml, as JSON lines otherwise",
+      default=[],
+      action="append"
+    )
+    parser.add_argument(
+      '--changed-since',
+      help="Only run the tests affected by the files changed since this git revision",
+      default=None,
+      type=str
+    )
+    parser.add_argument(
+      '--changed-files',
+      help="Only run the tests affected by this changed file, can be repeated, - reads a file per line from the standard input",
+      default=[],
+      action="append"
+    )
+    parser.add_argument(
+      '--shard',
+      help="Only run the Kth of N parts of the tests, balanced by the durations of the previous runs, as K/N",
+      default=None,
+      type=parse_shard
+    )
+    parser.add_argument(
+      '-O', '--order',
+      help="Order of the tests: failed tests of the previous runs first then the longest ones in parallel, or by name",
+      default="history",
+      choices=["history", "name"]
+    )
+    parser.add_argument(
+      '-d', '--diff',
+      help="Diff of the failed tests: a unified diff of the yaml texts, a list of the changed key paths, or auto to use the unified diff for small outputs only",
+      default="auto",
+      choices=["auto", "text", "tree"]
+    )
+    parser.add_argument(
+      '-p', '--profile',
+      help="Measure the time spent in every phase of the tests and their peak memory, and print the slowest tests",
+      default=False,
+      action="store_true"
+    )
+    parser.add_argument(
+      '--profile-top',
+      help="Number of slowest tests printed by --profile",
+      default=10,
+      type=int
+    )
+    parser.add_argument(
+      '--profile-dump',
+      help="Write the cProfile statistics of the run in this file, to be read with pstats",
+      default="",
+      type=str
+    )
+    args = parser.parse_args(argv)
     no_color = args.no_color
     verbose = args.verbose
+    diff_mode = args.diff
 
-    config_path = os.path.dirname(os.path.realpath(__file__))
-    config = configparser.ConfigParser()
-    config.read("{}/{}".format(config_path, 'template-tester.conf'))
+    config = read_config()
 
-    if 'DEFAULT' in config and 'test_dir' in config['DEFAULT']:
-        default_test_dir = config['DEFAULT']['test_dir']
-    else:
-        default_test_dir = "tests"
+    default_test_dir = configured_test_dir(config)
+
+    cache_dir = configured_cache_dir(config, args.cache_dir)
+    enable_caches(cache_dir)
+    index_files(["pillars", default_test_dir], cache_dir)
 
     if args.write_dir and not os.path.isdir(args.write_dir):
         os.mkdir(args.write_dir)
 
-    return_value = 0
+    test_files = collect_test_files(args.file, default_test_dir)
 
-    test_files = []
-    if type(args.file) == list and args.file:
-      for args_file in args.file:
-        if os.path.isdir(args_file):
-          print(
-            'is dir',
-            "{}/{}".format(
-              args_file.rstrip('/'),
-              "*.yml"
-            )
-          )
-          test_files += sorted(glob.glob(
-              "{}/**/{}".format(args_file.rstrip('/'), '*.yml'),
-              recursive=True
-          ))
-        else:
-          test_files += [args_file]
-    else:
-        test_files = sorted(glob.glob(
-            '{}/**/*.yml'.format(default_test_dir),
-            recursive=True
+    if args.shard and args.watch:
+        print("Error: --shard can not be used with --watch.")
+        return(1)
+
+    if args.changed_since is not None or args.changed_files:
+        changed = []
+        if args.changed_since is not None:
+            try:
+                changed += git_changed_files(args.changed_since)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print("Error: unable to list the files changed since {}: {}".format(args.changed_since, e))
+                return(1)
+        for changed_file in args.changed_files:
+            if changed_file == "-":
+                changed += [line.strip() for line in sys.stdin if line.strip()]
+            else:
+                changed.append(changed_file)
+        selected_test_files = changed_test_files(test_files, changed)
+        print("{} files changed, running {} of {} tests ...".format(
+            len(set(changed)), len(selected_test_files), len(test_files)
         ))
+        test_files = selected_test_files
 
     if args.stats:
         do_stats(test_files, config)
-        sys.exit(0)
+        return(0)
 
-    failed_tests = []
-    for testfile in test_files:
-        if testfile == "tests/template-tester.yml":
-            continue
-        test_return_value = run_tests(
-            open(testfile, 'r', encoding="utf-8"),
-            config,
-            outputdir=args.write_dir
-        )
-        return_value |= test_return_value
-        if test_return_value == 1:
-            failed_tests.append(testfile)
-            if args.stop:
-              break
+    if args.shard:
+        history = {}
+        if cache_dir:
+            history = load_results_db(os.path.join(cache_dir, "history.json"))
+        shard_files = shard_test_files(test_files, history, *args.shard)
+        print("Shard {}/{}: running {} of {} tests ...".format(
+            args.shard[0], args.shard[1], len(shard_files), len(test_files)
+        ))
+        test_files = shard_files
 
-    if return_value == 0:
-        print("All checks are ok.")
-    else:
+    if args.watch:
+        if not allow_watch:
+            print("Error: --watch can not be used through the server.")
+            return(1)
+        return(watch_tests(args.file, default_test_dir, config, args, cache_dir))
+
+    return(run_test_files(test_files, config, args, cache_dir))
+
+class ServerOutput(io.TextIOBase):
+    def __init__(self, connection, stream):
+        self.connection = connection
+        self.stream = stream
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        message = json.dumps({self.stream: data}) + "\n"
+        self.connection.sendall(message.encode("utf-8"))
+        return len(data)
+
+def handle_client(connection):
+    request = json.loads(connection.makefile('r', encoding="utf-8").readline())
+    # Templates may have changed since the previous request
+    template_dependency_cache.clear()
+    try:
+        with contextlib.redirect_stdout(ServerOutput(connection, 'stdout')), \
+             contextlib.redirect_stderr(ServerOutput(connection, 'stderr')):
+            try:
+                os.chdir(request['cwd'])
+                return_value = main(request['argv'], allow_watch=False)
+            except SystemExit as e:
+                return_value = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                return_value = 1
+        connection.sendall((json.dumps({'exit': return_value}) + "\n").encode("utf-8"))
+    except OSError:
+        # The client went away
+        pass
+
+def serve(argv):
+    parser = argparse.ArgumentParser(
+      prog="template-tester.py server",
+      description="Keep template-tester loaded and run the tests requested by 'template-tester.py client'"
+    )
+    parser.add_argument(
+      '--socket',
+      help="Unix socket to listen on",
+      default=default_socket_path,
+      type=str
+    )
+    args = parser.parse_args(argv)
+
+    socket_path = os.path.abspath(args.socket)
+    server_cwd = os.getcwd()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    print("Listening on {} ...".format(socket_path))
+    try:
+        while True:
+            connection, address = server.accept()
+            with connection:
+                handle_client(connection)
+            os.chdir(server_cwd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(socket_path)
+    return(0)
+
+def merge_results(argv):
+    parser = argparse.ArgumentParser(
+      prog="template-tester.py merge",
+      description="Merge the results of the shards of a run into one summary, exit code and coverage report"
+    )
+    parser.add_argument(
+      'reports',
+      help="JSON lines reports written by the shards with --report",
+      nargs="+"
+    )
+    parser.add_argument(
+      '--coverage-data',
+      help="Coverage directory written by a shard with --coverage, can be repeated",
+      default=[],
+      action="append"
+    )
+    parser.add_argument(
+      '-c', '--coverage',
+      help="Write the merged coverage reports in this directory",
+      default="",
+      type=str
+    )
+    parser.add_argument(
+      '-r', '--report',
+      help="Write the merged results in this file, as JUnit XML if its name ends with .xml, as JSON lines otherwise",
+      default=[],
+      action="append"
+    )
+    parser.add_argument(
+      '-C', '--cache-dir',
+      help="Record the durations of the merged tests in the history of this cache directory, for the next --shard",
+      default=None,
+      type=str
+    )
+    args = parser.parse_args(argv)
+
+    records = []
+    for filename in args.reports:
+        if filename.endswith(".xml"):
+            print("Error: {} is a JUnit report, only the JSON lines reports can be merged.".format(filename))
+            return(1)
+        try:
+            with open(filename, 'r', encoding="utf-8") as f:
+                records += [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            print("Error: unable to read the report {}: {}".format(filename, e))
+            return(1)
+
+    test_records = collections.OrderedDict()
+    for record in records:
+        test_records.setdefault(record['test'], []).append(record)
+    failed_tests = [
+        testfile for testfile, file_records in test_records.items()
+        if any(record['status'] != "passed" for record in file_records)
+    ]
+
+    cache_dir = configured_cache_dir(read_config(), args.cache_dir)
+    if cache_dir:
+        history_path = os.path.join(cache_dir, "history.json")
+        history = load_results_db(history_path)
+        for testfile, file_records in test_records.items():
+            history[testfile] = {
+                'duration': round(sum(record['duration'] for record in file_records), 6),
+                'failed': testfile in failed_tests,
+            }
+        save_results_db(history_path, history)
+
+    for filename in args.report:
+        report = open_report(filename)
+        for record in records:
+            report.write(record)
+        report.close()
+
+    if args.coverage_data:
+        coverage_data = {}
+        for directory in args.coverage_data:
+            try:
+                with open(os.path.join(directory, "coverage.json"), 'r', encoding="utf-8") as f:
+                    merge_coverage(coverage_data, json.load(f)['files'])
+            except (OSError, ValueError, KeyError) as e:
+                print("Error: unable to read the coverage data of {}: {}".format(directory, e))
+                return(1)
+        if args.coverage:
+            write_coverage_report(args.coverage, coverage_data)
+        print_coverage_summary(coverage_data)
+
+    if failed_tests:
         print("The following tests failed:")
         for failed_test in failed_tests:
             print("* {}".format(failed_test))
-    sys.exit(return_value)
+        return(1)
+    print("All checks are ok.")
+    return(0)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["server"]:
+        sys.exit(serve(sys.argv[2:]))
+    if sys.argv[1:2] == ["merge"]:
+        sys.exit(merge_results(sys.argv[2:]))
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,18 @@
+# Importable name of template-tester.py, for the library API and the pytest
+# plugin:
+#
+#   import template_tester
+#   config = template_tester.configure()
+#   for testfile in template_tester.collect_tests(config):
+#       records, output = template_tester.run_test(config, testfile)
+
+import os
+import sys
+import importlib.util
+
+_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "template-tester.py")
+_spec = importlib.util.spec_from_file_location(__name__, _path)
+_module = importlib.util.module_from_spec(_spec)
+# The module replaces this one, so its functions are pickled under this name
+sys.modules[__name__] = _module
+_spec.loader.exec_module(_module)
@@ -0,0 +1,37 @@
+import os
+import sys
+import textwrap
+import subprocess
+
+import pytest
+
+root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root_dir)
+template_tester_path = os.path.join(root_dir, "template-tester.py")
+
+class PillarTree():
+    # A project with pillars/ and tests/ in a temporary directory, tested by
+    # running template-tester.py in it
+    def __init__(self, path, cache_home):
+        self.path = path
+        self.cache_home = cache_home
+
+    def write(self, files):
+        for name, content in files.items():
+            path = self.path / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(textwrap.dedent(content).lstrip("\n"))
+
+    def run(self, *args):
+        return subprocess.run(
+            [sys.executable, template_tester_path, "-n"] + list(args),
+            cwd=str(self.path),
+            env=dict(os.environ, XDG_CACHE_HOME=str(self.cache_home)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+
+@pytest.fixture
+def tree(tmp_path, tmp_path_factory):
+    return PillarTree(tmp_path, tmp_path_factory.mktemp("cache"))
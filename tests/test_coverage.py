@@ -0,0 +1,51 @@
+import json
+
+import template_tester
+
+coverage_tree = {
+    "pillars/tested.yml": """
+        static: 1
+        {% if flag %}
+        flag: true
+        {% else %}
+        flag: false
+        {% endif %}
+        value: {{ value }}
+    """,
+    "pillars/untested.yml": """
+        untested: 1
+        value: {{ value }}
+    """,
+    "tests/tested.yml": """
+        file: pillars/tested.yml
+        variables: {pillar: {}, flag: true, value: 1}
+        expected: {static: 1, flag: true, value: 1}
+    """,
+}
+
+def test_coverage_counts_static_text_and_untested_templates(tree):
+    tree.write(coverage_tree)
+    result = tree.run("-C", "", "-c", "coverage")
+    assert result.returncode == 0, result.stdout
+    files = json.loads((tree.path / "coverage" / "coverage.json").read_text())['files']
+    assert files["pillars/tested.yml"]['lines'] == {"1": 1, "2": 1, "3": 1, "5": 0, "7": 1}
+    assert files["pillars/tested.yml"]['branches'] == {"2:then": 1, "2:else": 0}
+    assert files["pillars/untested.yml"]['lines'] == {"1": 0, "2": 0}
+    assert "Template coverage: 4/7 lines" in result.stdout
+
+def test_coverage_is_disabled_after_the_run(tree, monkeypatch):
+    # A server keeps the module loaded between the requests of its clients
+    tree.write(coverage_tree)
+    monkeypatch.chdir(tree.path)
+    assert template_tester.main(["-n", "-C", "", "-c", "coverage"], allow_watch=False) == 0
+    assert template_tester.CachedSandboxedEnvironment.coverage is None
+
+def test_coverage_is_the_same_on_every_run(tree, monkeypatch):
+    tree.write(coverage_tree)
+    monkeypatch.chdir(tree.path)
+    assert template_tester.main(["-n", "-C", "", "-c", "first"], allow_watch=False) == 0
+    assert template_tester.main(["-n", "-C", "", "-c", "second"], allow_watch=False) == 0
+    first = json.loads((tree.path / "first" / "coverage.json").read_text())
+    second = json.loads((tree.path / "second" / "coverage.json").read_text())
+    assert first['files']["pillars/tested.yml"]['lines']
+    assert first == second
@@ -0,0 +1,73 @@
+dependency_tree = {
+    "pillars/base.jinja": """
+        base:
+          {% block value %}value: 1{% endblock %}
+    """,
+    "pillars/extended.yml": """
+        {% extends 'base.jinja' %}
+        {% block value %}value: 2{% endblock %}
+    """,
+    "pillars/app/Debian.yml": """
+        os: Debian
+    """,
+    "pillars/computed.yml": """
+        {% include 'app/' ~ __grains__.os ~ '.yml' %}
+    """,
+    "tests/extended.yml": """
+        file: pillars/extended.yml
+        variables: {pillar: {}, __grains__: {}}
+        expected: {base: {value: 2}}
+    """,
+    "tests/computed.yml": """
+        file: pillars/computed.yml
+        variables: {pillar: {}, __grains__: {os: Debian}}
+        expected: {os: Debian}
+    """,
+}
+
+changed_dependencies = {
+    "pillars/base.jinja": """
+        changed:
+          {% block value %}value: 1{% endblock %}
+    """,
+    "pillars/app/Debian.yml": """
+        os: Changed
+    """,
+}
+
+def test_incremental_reruns_the_tests_of_extended_and_computed_templates(tree):
+    tree.write(dependency_tree)
+    result = tree.run("-i", "-O", "name")
+    assert result.returncode == 0, result.stdout
+
+    tree.write(changed_dependencies)
+    result = tree.run("-i", "-O", "name")
+    assert result.returncode == 1, result.stdout
+    assert "* tests/computed.yml" in result.stdout
+    assert "* tests/extended.yml" in result.stdout
+
+def test_changed_files_select_the_tests_of_extended_and_computed_templates(tree):
+    tree.write(dependency_tree)
+    tree.write(changed_dependencies)
+    result = tree.run("--changed-files", "pillars/app/Debian.yml", "--changed-files", "pillars/base.jinja")
+    assert "2 files changed, running 2 of 2 tests ..." in result.stdout
+    assert result.returncode == 1, result.stdout
+
+def test_changed_files_select_the_tests_extending_a_changed_template(tree):
+    tree.write(dependency_tree)
+    result = tree.run("--changed-files", "pillars/base.jinja", "-O", "name")
+    assert "1 files changed, running 2 of 2 tests ..." in result.stdout
+
+def test_changed_files_always_select_the_tests_of_computed_templates(tree):
+    tree.write(dependency_tree)
+    tree.write({"pillars/unrelated.yml": "unrelated: true\n"})
+    result = tree.run("--changed-files", "pillars/unrelated.yml")
+    assert "1 files changed, running 1 of 2 tests ..." in result.stdout
+    assert "Parsing tests/computed.yml" in result.stdout
+
+def test_default_cache_is_outside_of_the_checkout(tree):
+    tree.write(dependency_tree)
+    result = tree.run("-i", "-O", "name")
+    assert result.returncode == 0, result.stdout
+    assert sorted(path.name for path in tree.path.iterdir()) == ["pillars", "tests"]
+    assert [path.name for path in (tree.cache_home / "template-tester").iterdir()]
@@ -0,0 +1,41 @@
+content_tree = {
+    "pillars/text.yml": """
+        value: 1
+        other: 2
+    """,
+    "tests/content_partial.yml": """
+        file: pillars/text.yml
+        variables: {pillar: {}}
+        content_partial: |
+          value: 3
+    """,
+    "tests/content_partial_text.yml": """
+        file: pillars/text.yml
+        variables: {pillar: {}}
+        content_partial: |
+          missing
+    """,
+}
+
+def test_content_partial_uses_a_unified_diff(tree):
+    tree.write(content_tree)
+    result = tree.run("-C", "", "-O", "name", "--diff", "tree")
+    assert result.returncode == 1, result.stdout
+    assert "@@ -1 +1,2 @@\n-value: 3" in result.stdout
+    assert "+value: 1\n" in result.stdout
+    assert "-missing" in result.stdout
+    assert "$:" not in result.stdout
+
+def test_content_partial_of_non_yaml_output(tree):
+    tree.write({
+        "pillars/raw.yml": """
+            value: [unclosed
+        """,
+        "tests/raw.yml": """
+            file: pillars/raw.yml
+            variables: {pillar: {}}
+            content_partial: "[unclosed"
+        """,
+    })
+    result = tree.run("-C", "")
+    assert result.returncode == 0, result.stdout
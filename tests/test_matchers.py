@@ -0,0 +1,87 @@
+import copy
+import random
+
+import template_tester
+
+scalars = [1, 2, 1.0, True, "a", "b", None]
+
+def random_value(rng, depth):
+    draw = rng.random()
+    if depth > 3 or draw < 0.4:
+        return rng.choice(scalars)
+    if draw < 0.7:
+        return dict((rng.choice("xyzw"), random_value(rng, depth + 1)) for i in range(rng.randint(0, 3)))
+    return [
+        random_value(rng, depth + 2) if rng.random() < 0.2 else rng.choice([1, 2, 3, "a"])
+        for i in range(rng.randint(0, 4))
+    ]
+
+def random_expected(rng, generated, depth=0):
+    # Mostly a subset of generated, with some values changed or added
+    if isinstance(generated, dict):
+        expected = dict(
+            (key, random_expected(rng, value, depth + 1))
+            for key, value in generated.items() if rng.random() < 0.7
+        )
+        if rng.random() < 0.2:
+            expected[rng.choice("xyzw")] = random_value(rng, depth)
+        if rng.random() < 0.05:
+            expected["__*"] = random_value(rng, 3)
+        return expected
+    if isinstance(generated, list):
+        expected = [item for item in generated if rng.random() < 0.6]
+        if rng.random() < 0.2:
+            expected.append(rng.choice([1, 9]))
+        return expected
+    if rng.random() < 0.85:
+        return generated
+    return random_value(rng, 4)
+
+def test_match_partial_agrees_with_merge_trees():
+    rng = random.Random(1)
+    for i in range(5000):
+        generated = dict((key, random_value(rng, 1)) for key in "xyzw" if rng.random() < 0.8)
+        expected = random_expected(rng, generated)
+        generated_copy = copy.deepcopy(generated)
+        expected_copy = copy.deepcopy(expected)
+        merged, normalized = template_tester.merge_trees(generated, expected)
+        assert bool(template_tester.match_partial(expected, generated)) == (merged != normalized), (generated, expected)
+        assert dict(template_tester.mergedicts(generated, expected)) == merged
+        assert generated == generated_copy
+        assert expected == expected_copy
+
+def test_match_partial_wildcard():
+    generated = {"a": {"x": 1, "y": 2}, "b": {"x": 1}}
+    assert template_tester.match_partial({"__*": {"x": 1}}, generated) == []
+    assert template_tester.match_partial({"__*": {"y": 2}}, generated) == [("b", "y")]
+    # The generated values take precedence over the ones of the wildcard
+    assert template_tester.match_partial({"__*": {"x": 2}}, generated) == []
+    assert template_tester.match_partial({"__*": 1}, {"a": 1, "b": 2}) == [("b",)]
+    assert template_tester.match_partial({"a": {"__*": 1}}, {"a": {"x": 1}, "b": 2}) == []
+
+def test_match_partial_lists_of_dicts():
+    generated = {"l": [{"a": 1}, {"b": [1, 2]}]}
+    assert template_tester.match_partial({"l": [{"b": [1, 2]}]}, generated) == []
+    assert template_tester.match_partial({"l": [{"a": 1}, {"b": [1, 2]}]}, generated) == []
+    assert template_tester.match_partial({"l": [{"b": [2]}]}, generated) == [("l",)]
+    assert template_tester.match_partial({"l": [{"c": 3}]}, generated) == [("l",)]
+
+def test_match_absent_none_leaves():
+    generated = {"a": {"b": 1, "n": None}, "l": ["x", "y"]}
+    assert template_tester.match_absent({"a": {"b": None}}, generated) == [("a", "b")]
+    assert template_tester.match_absent({"a": {"n": None}}, generated) == [("a", "n")]
+    assert template_tester.match_absent({"a": {"c": None}}, generated) == []
+    assert template_tester.match_absent({"c": {"b": None}}, generated) == []
+    assert template_tester.match_absent({"l": {"x": None}}, generated) == [("l", "x")]
+    assert template_tester.match_absent({"l": {"z": None}}, generated) == []
+
+def test_match_absent_scalars_have_no_keys():
+    generated = {"a": "hello"}
+    assert template_tester.match_absent({"a": {1: None}}, generated) == []
+    assert template_tester.match_absent({"a": {"ell": None}}, generated) == []
+
+def test_match_absent_values():
+    generated = {"a": {"b": 1}}
+    assert template_tester.match_absent({"a": {"b": 1}}, generated) == [("a", "b")]
+    assert template_tester.match_absent({"a": {"b": 2}}, generated) == []
+    assert template_tester.match_absent({"a": None}, generated) == [("a",)]
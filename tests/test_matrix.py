@@ -0,0 +1,60 @@
+import json
+
+matrix_tree = {
+    "pillars/os.yml": """
+        os: {{ __grains__.os }}
+        env: {{ pillar.env }}
+    """,
+}
+
+def run_matrix_test(tree, test):
+    tree.write(matrix_tree)
+    tree.write({"tests/matrix.yml": test})
+    result = tree.run("-C", "", "-r", "report.jsonl")
+    records = [json.loads(line) for line in (tree.path / "report.jsonl").read_text().splitlines()]
+    return result, records
+
+def test_matrix_runs_every_combination(tree):
+    result, records = run_matrix_test(tree, """
+        file: pillars/os.yml
+        variables: {pillar: {}}
+        matrix:
+          __grains__.os: [Debian, RedHat]
+          pillar.env: [prod, staging]
+        expected_partial: {os: Debian}
+        matrix_cases:
+          - when: {__grains__.os: RedHat}
+            expected_partial: {os: RedHat}
+    """)
+    assert result.returncode == 0, result.stdout
+    assert sorted(record['case'] for record in records) == [
+        "__grains__.os=Debian, pillar.env=prod",
+        "__grains__.os=Debian, pillar.env=staging",
+        "__grains__.os=RedHat, pillar.env=prod",
+        "__grains__.os=RedHat, pillar.env=staging",
+    ]
+    assert set(record['status'] for record in records) == {"passed"}
+
+def test_matrix_scalar_axis_is_an_error(tree):
+    result, records = run_matrix_test(tree, """
+        file: pillars/os.yml
+        variables: {pillar: {env: prod}}
+        matrix:
+          __grains__.os: Debian
+        expected_partial: {os: Debian}
+    """)
+    assert result.returncode == 1, result.stdout
+    assert [(record['status'], record['reason']) for record in records] == [
+        ("error", "matrix axis __grains__.os must be a non-empty list of values")
+    ]
+
+def test_matrix_empty_axis_is_an_error(tree):
+    result, records = run_matrix_test(tree, """
+        file: pillars/os.yml
+        variables: {pillar: {env: prod}}
+        matrix:
+          __grains__.os: []
+        expected_partial: {os: Debian}
+    """)
+    assert result.returncode == 1, result.stdout
+    assert [record['status'] for record in records] == ["error"]
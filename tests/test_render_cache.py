@@ -0,0 +1,20 @@
+def test_renders_are_not_shared_between_equal_looking_variables(tree):
+    tree.write({
+        "pillars/t.yml": """
+            x: {{ pillar.x }}
+            users: [{% for u in pillar.users %}{{ u }}{% if not loop.last %}, {% endif %}{% endfor %}]
+        """,
+        "tests/a.yml": """
+            file: pillars/t.yml
+            variables: {pillar: {x: 0, users: {alice: 1, bob: 2}}, __grains__: {}}
+            expected: {x: 0, users: [alice, bob]}
+        """,
+        "tests/b.yml": """
+            file: pillars/t.yml
+            variables: {pillar: {x: false, users: {bob: 2, alice: 1}}, __grains__: {}}
+            expected: {x: false, users: [bob, alice]}
+        """,
+    })
+    result = tree.run("-C", "", "-O", "name")
+    assert result.returncode == 0, result.stdout
+    assert "All checks are ok." in result.stdout
@@ -0,0 +1,46 @@
+import json
+import xml.etree.ElementTree as ElementTree
+
+report_tree = {
+    "pillars/broken.yml": """
+        value: {{ undefined_variable.attribute }}
+    """,
+    "pillars/invalid.yml": """
+        value: [unclosed
+    """,
+    "pillars/good.yml": """
+        value: 1
+    """,
+    "tests/broken.yml": """
+        file: pillars/broken.yml
+        variables: {pillar: {}}
+        expected: {value: 1}
+    """,
+    "tests/invalid.yml": """
+        file: pillars/invalid.yml
+        variables: {pillar: {}}
+        expected: {value: 1}
+    """,
+    "tests/good.yml": """
+        file: pillars/good.yml
+        variables: {pillar: {}}
+        expected: {value: 1}
+    """,
+}
+
+def test_render_and_load_errors_are_reported(tree):
+    tree.write(report_tree)
+    result = tree.run("-C", "", "-O", "name", "-r", "report.xml", "-r", "report.jsonl")
+    assert result.returncode == 1, result.stdout
+    assert "Parsing tests/good.yml" in result.stdout
+
+    records = [json.loads(line) for line in (tree.path / "report.jsonl").read_text().splitlines()]
+    statuses = {record['test']: record['status'] for record in records}
+    assert statuses == {"tests/broken.yml": "error", "tests/good.yml": "passed", "tests/invalid.yml": "error"}
+    reasons = {record['test']: record['reason'] for record in records}
+    assert "Traceback" in reasons["tests/broken.yml"]
+    assert "Traceback" in reasons["tests/invalid.yml"]
+
+    suite = ElementTree.parse(str(tree.path / "report.xml")).getroot()
+    errors = [case for case in suite.iter("testcase") if case.find("error") is not None]
+    assert len(errors) == 2
@@ -0,0 +1,32 @@
+stack_tree = {
+    "pillars/stack/stack.cfg": """
+        common.yml
+        os/{{ __grains__.os }}.yml
+    """,
+    "pillars/stack/common.yml": """
+        common: true
+    """,
+    "pillars/stack/os/Debian.yml": """
+        os_family: Debian
+    """,
+}
+
+def test_stack_test_without_assertion_reports_no_condition(tree):
+    tree.write(stack_tree)
+    tree.write({
+        "tests/no_condition.yml": """
+            stack: pillars/stack/stack.cfg
+            variables: {pillar: {}, __grains__: {os: Debian}}
+        """,
+        "tests/partial.yml": """
+            stack: pillars/stack/stack.cfg
+            variables: {pillar: {}, __grains__: {os: Debian}}
+            expected_partial: {common: true, os_family: Debian}
+        """,
+    })
+    result = tree.run("-C", "", "-O", "name")
+    assert result.returncode == 1, result.stdout
+    assert "No condition to test." in result.stdout
+    assert "Parsing tests/partial.yml" in result.stdout
+    assert "* tests/no_condition.yml" in result.stdout
+    assert "* tests/partial.yml" not in result.stdout
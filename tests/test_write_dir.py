@@ -0,0 +1,60 @@
+import json
+import os
+
+import template_tester
+
+write_dir_tree = {
+    "pillars/p.yml": """
+        value: 1
+    """,
+    "tests/ok.yml": """
+        file: pillars/p.yml
+        variables: {pillar: {}}
+        expected: {value: 1}
+    """,
+}
+
+def test_absolute_test_path_is_written_under_the_write_dir(tree):
+    tree.write(write_dir_tree)
+    result = tree.run("-C", "", "-w", "out", str(tree.path / "tests" / "ok.yml"))
+    assert result.returncode == 0, result.stdout
+    assert (tree.path / "out" / "tests" / "ok" / "pillars" / "p.yml").read_text() == "value: 1\n"
+    assert not (tree.path / "tests" / "ok").exists()
+    result = tree.run("-C", "", "-w", "out")
+    assert result.returncode == 0, result.stdout
+
+def test_absolute_target_is_written_under_the_write_dir(tree):
+    tree.write(write_dir_tree)
+    tree.write({
+        "tests/absolute.yml": """
+            file: {}
+            variables: {{pillar: {{}}}}
+            expected: {{value: 1}}
+        """.format(tree.path / "pillars" / "p.yml"),
+    })
+    result = tree.run("-C", "", "-w", "out", "tests/absolute.yml")
+    assert result.returncode == 0, result.stdout
+    assert (tree.path / "out" / "tests" / "absolute" / "pillars" / "p.yml").exists()
+    assert (tree.path / "pillars" / "p.yml").read_text() == "value: 1\n"
+
+def test_output_paths_stay_under_the_write_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert template_tester.output_path("../tests/t.yml", "../../pillars/p.yml") == os.path.join(
+        "tests", "t", "pillars", "p.yml"
+    )
+    assert template_tester.output_path("tests/t.yml", "/pillars/../../p.yml") == os.path.join("tests", "t", "p.yml")
+    assert template_tester.in_output_dir("out", os.path.join("tests", "t.yml"))
+    assert not template_tester.in_output_dir("out", os.path.join("..", "t.yml"))
+    assert not template_tester.in_output_dir("out", str(tmp_path / "t.yml"))
+
+def test_manifest_cleanup_stays_under_the_write_dir(tmp_path):
+    (tmp_path / "out").mkdir()
+    victim = tmp_path / "victim.yml"
+    victim.write_text("value: 1\n")
+    (tmp_path / "out" / "manifest.json").write_text(json.dumps({'files': {
+        os.path.join("..", "victim.yml"): {'test': "tests/t.yml", 'target': None, 'case': None, 'sha256': ""},
+        str(victim): {'test': "tests/t.yml", 'target': None, 'case': None, 'sha256': ""},
+    }}))
+    template_tester.write_output_manifest(str(tmp_path / "out"), {"tests/t.yml"}, [])
+    assert victim.read_text() == "value: 1\n"
+    assert json.loads((tmp_path / "out" / "manifest.json").read_text()) == {'files': {}}